@@ -1,198 +1,507 @@
-import snowflake.connector
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
-import requests
-import json
-import base64
-from sqlalchemy import create_engine
-import boto3
-import pandas as pd
-
-#Load secrets from secrets manager
-def get_secrets(secret_names, region_name="us-east-1"):
-    secrets = {}
-    
-    client = boto3.client(
-        service_name='secretsmanager',
-    )
-    
-    for secret_name in secret_names:
-        try:
-            get_secret_value_response = client.get_secret_value(
-                SecretId=secret_name)
-        except Exception as e:
-                raise e
-        else:
-            if 'SecretString' in get_secret_value_response:
-                secrets[secret_name] = get_secret_value_response['SecretString']
-            else:
-                secrets[secret_name] = base64.b64decode(get_secret_value_response['SecretBinary'])
-
-    return secrets
-    
-#Extract secret values from fetched secrets
-def extract_secret_value(data):
-    if isinstance(data, str):
-        return json.loads(data)
-    return data
-
-secrets = ['maxio_core_api_key','snowflake_bizops_user','snowflake_account','snowflake_key_pass','snowflake_bizops_wh','snowflake_fivetran_db','snowflake_bizops_role','maxio_base_url']
-
-fetch_secrets = get_secrets(secrets)
-
-extracted_secrets = {key: extract_secret_value(value) for key, value in fetch_secrets.items()}
-
-maxio_core_api_key = extracted_secrets['maxio_core_api_key']['maxio_core_api_key']
-maxio_base_url = extracted_secrets['maxio_base_url']['maxio_base_url']
-snowflake_user = extracted_secrets['snowflake_bizops_user']['snowflake_bizops_user']
-snowflake_account = extracted_secrets['snowflake_account']['snowflake_account']
-snowflake_key_pass = extracted_secrets['snowflake_key_pass']['snowflake_key_pass']
-snowflake_bizops_wh = extracted_secrets['snowflake_bizops_wh']['snowflake_bizops_wh']
-snowflake_schema = 'MAXIO_SAASOPTICS'
-snowflake_fivetran_db = extracted_secrets['snowflake_fivetran_db']['snowflake_fivetran_db']
-snowflake_role = extracted_secrets['snowflake_bizops_role']['snowflake_bizops_role']
-
-password = snowflake_key_pass.encode()
-
-#AWS S3 Configuration params
-s3_bucket = 'aws-glue-assets-bianalytics'
-s3_key = 'BIZ_OPS_ETL_USER.p8'
-
-#Function to download file from S3
-def download_from_s3(bucket, key):
-    s3_client = boto3.client('s3')
-    try:
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        return response['Body'].read()
-    except Exception as e:
-        print(f"Error downloading from S3: {e}")
-        return None
-
-#Download the private key file from S3
-key_data = download_from_s3(s3_bucket, s3_key)
-
-#Load the private key as PEM
-private_key = load_pem_private_key(key_data, password=password)
-
-#Extract the private key bytes in PKCS8 format
-private_key_bytes = private_key.private_bytes(
-    encoding=serialization.Encoding.DER,
-    format=serialization.PrivateFormat.PKCS8,
-    encryption_algorithm=serialization.NoEncryption())
-    
-ctx = snowflake.connector.connect(
-    user=snowflake_user,
-    account=snowflake_account,
-    private_key=private_key_bytes,
-    role=snowflake_role,
-    warehouse=snowflake_bizops_wh)
-    
-staging_table_name = 'INTEGRATION_STAGING_TEMP_CONTRACT'
-
-#Clear the intermediate staging table
-cs = ctx.cursor()
-script = f"""
-delete from "{snowflake_fivetran_db}"."{snowflake_schema}"."{staging_table_name}"
-"""
-payload = cs.execute(script)
-
-table_name = 'INTEGRATION_STAGING'
-
-#Fetch rows that still require data enrichment
-cs = ctx.cursor()
-script = f"""
-select
-*
-from "{snowflake_fivetran_db}"."{snowflake_schema}"."{table_name}"
-where (lower(ab_contract_assoc_complete) = 'false')
-"""
-payload = cs.execute(script)
-contract_assocs_needed = pd.DataFrame.from_records(iter(payload), columns=[x[0] for x in payload.description])
-
-#Extract customer ids from snowflake results
-customer_ids = ", ".join(contract_assocs_needed['AB_REFERENCE'].apply(lambda x: f"'{x}'"))
-
-#Get details about customers who need enrichment from snowflake
-cs = ctx.cursor()
-script = f"""
-select 
-o.number as sf_act_id,
-c.id as contract_id,
-o.id as customer_id,
-c.text_field_2
-from "{snowflake_fivetran_db}"."{snowflake_schema}"."CONTRACT" c
-inner join "{snowflake_fivetran_db}"."{snowflake_schema}"."CUSTOMER" o on o.id = c.customer_id
-inner join "{snowflake_fivetran_db}"."{snowflake_schema}"."REGISTER" r on c.register_id = r.id
-where lower(r.name) like '%cashe% and sf_act_id in ({customer_ids})
-"""
-payload = cs.execute(script)
-customer_update = pd.DataFrame.from_records(iter(payload), columns=[x[0] for x in payload.description])
-
-#Do some data cleanup, begin preparing import dataframe
-customers_missing_value = customer_update.rename(columns={'SF_ACT_ID':'AB_REFERENCE'})
-customers_missing_value['AB_CONTRACT_ASSOC_COMPLETE'] = True
-customers_missing_value_final = customers_missing_value.drop(columns=['CONTRACT_ID','CUSTOMER_ID','TEXT_FIELD_2'])
-
-merged_customer_list = pd.merge(customers_missing_value_final,contract_assocs_needed,left_on='AB_REFERENCE',right_on='AB_REFERENCE')
-merged_customer_list_final = pd.merge(merged_customer_list,customer_update,left_on='AB_REFERENCE',right_on='SF_ACT_ID')
-
-#Function to extract necessary data from dataframe
-def extract_ids_from_dataframe(df):
-    return [
-        {
-            'id': row['CONTRACT_ID'],
-            'text_field2': row['AB_SUBSCRIPTION']
-        }
-        for _, row in df.iterrows()
-    ]
-
-result = extract_ids_from_dataframe(merged_customer_list_final)
-
-#Send a patch request to core contracts endpoint to write AB subscription ids to Core
-base_url = f'{maxio_base_url}/api/v1.0/contracts/'
-
-for item in result:
-    contract_id = item['id']
-    text_field2 = item['text_field2']
-    
-    url = f'{base_url}{contract_id}/'
-
-    headers = {
-        'Authorization': f'Token {maxio_core_api_key}',
-        'Content-Type': 'application/json'
-    }
-    
-    payload = {
-        "text_field2": text_field2
-    }
-    
-    response = requests.patch(url, headers=headers, json=payload)
-    
-#Construct the SQLAlchemy connection string
-connection_string = f"snowflake://{snowflake_user}@{snowflake_account}/{snowflake_fivetran_db}/{snowflake_schema}?warehouse={snowflake_bizops_wh}&role={snowflake_role}&authenticator=externalbrowser"
-
-#Instantiate SQLAlchemy engine with the private key
-engine = create_engine(
-        connection_string,
-        connect_args={
-            "private_key": private_key_bytes
-        }
-    )
-
-#Write the updated customers to snowflake int staging table
-customers_missing_value_final.to_sql(staging_table_name, engine, if_exists='append', index=False, method='multi', chunksize=1000)
-
-#Merge the updated rows with the final staging table
-merge_sql = f"""
-MERGE INTO {table_name} AS target
-USING "{snowflake_fivetran_db}"."{snowflake_schema}"."{staging_table_name}" AS staging
-ON target.AB_REFERENCE = staging.AB_REFERENCE
-WHEN MATCHED THEN
-    UPDATE SET
-target.AB_CONTRACT_ASSOC_COMPLETE=staging.AB_CONTRACT_ASSOC_COMPLETE;
-COMMIT;"""
-engine.execute(merge_sql)
-
-
-
-
+import snowflake.connector
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import random
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import base64
+import boto3
+import time
+import os
+
+#CloudWatch Embedded Metric Format telemetry: duration, call count and payload bytes per stage and per downstream system
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'SFDC-MaxioAB-Integration')
+METRICS_SERVICE = 'integration-updater'
+
+#Append the records to this json-lines file instead of printing them to the job's CloudWatch log, for running without AWS
+METRICS_FILE = os.environ.get('METRICS_FILE')
+
+#Totals since the last flush, (kind, name) -> metrics, kind is 'Stage' or 'System'
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+#Add one call to a stage's or downstream system's totals
+def record_metric(kind, name, seconds, payload_bytes=0):
+    with _metrics_lock:
+        totals = _metrics.setdefault((kind, name), {'Duration': 0.0, 'Calls': 0, 'Bytes': 0})
+        totals['Duration'] += seconds * 1000
+        totals['Calls'] += 1
+        totals['Bytes'] += payload_bytes
+
+#Time a block as one call of a stage, or of a downstream system with kind='System'
+#The span dict is yielded so the block can add the payload bytes it sent and received
+@contextmanager
+def span(name, kind='Stage'):
+    current = {'bytes': 0}
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        record_metric(kind, name, time.perf_counter() - started, current['bytes'])
+
+#Emit one EMF record per stage and per system seen since the last flush
+def flush_metrics(properties=None):
+    with _metrics_lock:
+        totals = dict(_metrics)
+        _metrics.clear()
+    timestamp = int(time.time() * 1000)
+
+    lines = []
+    for (kind, name), values in sorted(totals.items()):
+        record = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Service', kind]],
+                    'Metrics': [
+                        {'Name': 'Duration', 'Unit': 'Milliseconds'},
+                        {'Name': 'Calls', 'Unit': 'Count'},
+                        {'Name': 'Bytes', 'Unit': 'Bytes'}
+                    ]
+                }]
+            },
+            'Service': METRICS_SERVICE,
+            kind: name,
+            'Duration': round(values['Duration'], 1),
+            'Calls': values['Calls'],
+            'Bytes': values['Bytes']
+        }
+        record.update(properties or {})
+        lines.append(json.dumps(record))
+
+    if not lines:
+        return
+    if METRICS_FILE:
+        with open(METRICS_FILE, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines), flush=True)
+
+#How long parsed secrets stay cached in memory before being fetched again
+SECRETS_TTL_SECONDS = int(os.environ.get('SECRETS_TTL_SECONDS', '3600'))
+
+#Where secrets come from: 'aws' (Secrets Manager), 'file' (LOCAL_SECRETS_FILE json) or 'env' (SECRET_<NAME> variables)
+SECRETS_SOURCE = os.environ.get('SECRETS_SOURCE', 'aws')
+
+#Parsed secrets cache, secret name -> (fetched_at, value)
+_secrets_cache = {}
+
+#Outbound HTTP connection pooling: per-host pool sizes, timeout and retry policy for 429/5xx
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', '30'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+#Core contract PATCH fan-out: concurrent requests, sustained request rate and burst allowed by the token bucket
+CORE_MAX_WORKERS = int(os.environ.get('CORE_MAX_WORKERS', '8'))
+CORE_RATE_PER_SECOND = float(os.environ.get('CORE_RATE_PER_SECOND', '10'))
+CORE_RATE_BURST = int(os.environ.get('CORE_RATE_BURST', '10'))
+
+#Attempts per contract when Core keeps answering 429
+CORE_MAX_ATTEMPTS = int(os.environ.get('CORE_MAX_ATTEMPTS', '4'))
+
+#Statuses the session retries on its own for Core PATCHes, 429 is left to the shared token bucket so a throttled worker
+#pauses every worker and its resends take tokens, instead of urllib3 sleeping and resending inside one worker
+CORE_PATCH_RETRY_STATUSES = (500, 502, 503, 504)
+
+#Pending rows are retried with exponential backoff from ASSOC_RETRY_BASE_MINUTES up to ASSOC_RETRY_MAX_MINUTES between attempts
+#and given up after ASSOC_MAX_ATTEMPTS, rows older than ASSOC_MAX_AGE_DAYS are never scanned
+ASSOC_RETRY_BASE_MINUTES = int(os.environ.get('ASSOC_RETRY_BASE_MINUTES', '15'))
+ASSOC_RETRY_MAX_MINUTES = int(os.environ.get('ASSOC_RETRY_MAX_MINUTES', '1440'))
+ASSOC_MAX_ATTEMPTS = int(os.environ.get('ASSOC_MAX_ATTEMPTS', '20'))
+ASSOC_MAX_AGE_DAYS = int(os.environ.get('ASSOC_MAX_AGE_DAYS', '30'))
+
+#Keep-alive sessions, one per host and retry policy
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+#Return the pooled keep-alive session for the host in url that retries retry_statuses on its own
+def get_http_session(url, retry_statuses=HTTP_RETRY_STATUSES):
+    host = urlparse(url).netloc
+    with _http_sessions_lock:
+        session = _http_sessions.get((host, retry_statuses))
+        if session is None:
+            retry = Retry(
+                total=HTTP_MAX_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=list(retry_statuses),
+                allowed_methods=None,
+                #urllib3 retries any 429 carrying Retry-After when this is on, whatever status_forcelist says
+                respect_retry_after_header=429 in retry_statuses,
+                raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[(host, retry_statuses)] = session
+    return session
+
+#Send a request over the pooled session for its host, timed as the downstream system (the host by default)
+def http_request(method, url, system=None, retry_statuses=HTTP_RETRY_STATUSES, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT_SECONDS)
+    with span(system or urlparse(url).netloc, kind='System') as current:
+        response = get_http_session(url, retry_statuses).request(method, url, **kwargs)
+        current['bytes'] = len(response.request.body or b'') + len(response.content)
+    return response
+
+#Connections opened vs requests sent per host, a high ratio of requests to connections means keep-alive is working
+def http_session_stats():
+    stats = {}
+    with _http_sessions_lock:
+        for (host, retry_statuses), session in _http_sessions.items():
+            host_stats = stats.setdefault(host, {'connections': 0, 'requests': 0})
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    host_stats['connections'] += pool.num_connections
+                    host_stats['requests'] += pool.num_requests
+    return stats
+
+#Extract secret values from fetched secrets
+def extract_secret_value(data):
+    if isinstance(data, str):
+        return json.loads(data)
+    return data
+
+#The string or decoded binary value of a fetched secret
+def secret_payload(secret):
+    if 'SecretString' in secret:
+        return secret['SecretString']
+    return base64.b64decode(secret['SecretBinary'])
+
+#Fetch secrets from secrets manager, batching up to 20 names per call
+def fetch_secrets_aws(secret_names, region_name):
+    secrets = {}
+
+    client = boto3.client(
+        service_name='secretsmanager',
+        region_name=region_name
+    )
+
+    #The batch call needs boto3 1.33+, an older preinstalled boto3 falls back to one call per secret
+    if not hasattr(client, 'batch_get_secret_value'):
+        for secret_name in secret_names:
+            secrets[secret_name] = secret_payload(client.get_secret_value(SecretId=secret_name))
+        return secrets
+
+    for i in range(0, len(secret_names), 20):
+        response = client.batch_get_secret_value(SecretIdList=secret_names[i:i + 20])
+        if response.get('Errors'):
+            raise RuntimeError(f"Error fetching secrets: {response['Errors']}")
+        for secret in response['SecretValues']:
+            secrets[secret['Name']] = secret_payload(secret)
+
+    return secrets
+
+#Local stand-in for secrets manager so the pipeline can run offline
+def fetch_secrets_local(secret_names):
+    stored = {}
+    if SECRETS_SOURCE == 'file':
+        with open(os.environ['LOCAL_SECRETS_FILE']) as f:
+            stored = json.load(f)
+
+    secrets = {}
+    for secret_name in secret_names:
+        value = stored.get(secret_name, os.environ.get(f"SECRET_{secret_name.upper()}"))
+        if value is None:
+            raise KeyError(f"Secret {secret_name} not found in local secrets")
+        secrets[secret_name] = value if isinstance(value, str) else json.dumps(value)
+
+    return secrets
+
+#Load secrets, fetching only the missing or expired ones in a single batch and caching the parsed values
+def get_secrets(secret_names, region_name="us-east-1"):
+    now = time.time()
+    missing = [name for name in secret_names if name not in _secrets_cache or now - _secrets_cache[name][0] > SECRETS_TTL_SECONDS]
+
+    if missing:
+        with span('secretsmanager', kind='System'):
+            if SECRETS_SOURCE == 'aws':
+                fetched = fetch_secrets_aws(missing, region_name)
+            else:
+                fetched = fetch_secrets_local(missing)
+        for secret_name, value in fetched.items():
+            _secrets_cache[secret_name] = (now, extract_secret_value(value))
+
+    return {name: _secrets_cache[name][1] for name in secret_names}
+
+secrets = ['maxio_core_api_key','snowflake_bizops_user','snowflake_account','snowflake_key_pass','snowflake_bizops_wh','snowflake_fivetran_db','snowflake_bizops_role','maxio_base_url']
+
+extracted_secrets = get_secrets(secrets)
+
+maxio_core_api_key = extracted_secrets['maxio_core_api_key']['maxio_core_api_key']
+maxio_base_url = extracted_secrets['maxio_base_url']['maxio_base_url']
+snowflake_user = extracted_secrets['snowflake_bizops_user']['snowflake_bizops_user']
+snowflake_account = extracted_secrets['snowflake_account']['snowflake_account']
+snowflake_key_pass = extracted_secrets['snowflake_key_pass']['snowflake_key_pass']
+snowflake_bizops_wh = extracted_secrets['snowflake_bizops_wh']['snowflake_bizops_wh']
+snowflake_schema = 'MAXIO_SAASOPTICS'
+snowflake_fivetran_db = extracted_secrets['snowflake_fivetran_db']['snowflake_fivetran_db']
+snowflake_role = extracted_secrets['snowflake_bizops_role']['snowflake_bizops_role']
+
+password = snowflake_key_pass.encode()
+
+#AWS S3 Configuration params
+s3_bucket = 'aws-glue-assets-bianalytics'
+s3_key = 'BIZ_OPS_ETL_USER.p8'
+
+#Function to download file from S3
+def download_from_s3(bucket, key):
+    s3_client = boto3.client('s3')
+    try:
+        with span('s3', kind='System') as current:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            body = response['Body'].read()
+            current['bytes'] = len(body)
+        return body
+    except Exception as e:
+        print(f"Error downloading from S3: {e}")
+        return None
+
+#Download the private key file from S3
+key_data = download_from_s3(s3_bucket, s3_key)
+
+#Load the private key as PEM
+private_key = load_pem_private_key(key_data, password=password)
+
+#Extract the private key bytes in PKCS8 format
+private_key_bytes = private_key.private_bytes(
+    encoding=serialization.Encoding.DER,
+    format=serialization.PrivateFormat.PKCS8,
+    encryption_algorithm=serialization.NoEncryption())
+    
+with span('snowflake_connect'), span('snowflake', kind='System'):
+    ctx = snowflake.connector.connect(
+        user=snowflake_user,
+        account=snowflake_account,
+        private_key=private_key_bytes,
+        role=snowflake_role,
+        warehouse=snowflake_bizops_wh)
+    
+table_name = 'INTEGRATION_STAGING'
+
+#Only contracts in Core registers whose name matches this pattern are linked to AB subscriptions
+CORE_REGISTER_NAME_PATTERN = '%cashe%'
+
+#Token bucket shared by every PATCH worker, so the whole job stays under Core's rate limit
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    #Block until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_seconds = (1 - self.tokens) / self.rate
+                else:
+                    wait_seconds = self.paused_until - now
+            time.sleep(wait_seconds)
+
+    #Stop every worker for a while after Core answers 429
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+#Seconds to back off after a 429, from Retry-After when Core sends it
+def retry_after_seconds(response, attempt):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30) * random.uniform(0.5, 1)
+
+#Send a patch request to core contracts endpoint to write AB subscription ids to Core
+core_contracts_url = f'{maxio_base_url}/api/v1.0/contracts/'
+core_headers = {
+    'Authorization': f'Token {maxio_core_api_key}',
+    'Content-Type': 'application/json'
+}
+
+#PATCH a batch of contracts on the shared worker pool, paced by the shared token bucket
+#Returns the items Core confirmed with a 2xx and the failures with their status or error
+def patch_contracts(items, executor, bucket):
+    def patch(item):
+        url = f"{core_contracts_url}{item['id']}/"
+        for attempt in range(1, CORE_MAX_ATTEMPTS + 1):
+            bucket.acquire()
+            try:
+                response = http_request('PATCH', url, system='maxio_core', retry_statuses=CORE_PATCH_RETRY_STATUSES, headers=core_headers, json={"text_field2": item['text_field2']})
+            except requests.RequestException as e:
+                return item, str(e)
+            if response.status_code != 429:
+                break
+            bucket.pause(retry_after_seconds(response, attempt))
+        if 200 <= response.status_code < 300:
+            return item, None
+        return item, f"HTTP {response.status_code}: {response.text[:200]}"
+
+    succeeded = []
+    failed = []
+    for item, error in executor.map(patch, items):
+        if error is None:
+            succeeded.append(item)
+        else:
+            failed.append((item, error))
+            print(f"PATCH contract {item['id']} failed: {error}")
+    return succeeded, failed
+
+#Rows fetched from the cursor at a time, memory stays bounded by this however large the backlog is
+GLUE_FETCH_BATCH_ROWS = int(os.environ.get('GLUE_FETCH_BATCH_ROWS', '1000'))
+
+#Most keys in one completion MERGE, the connector's default pyformat binding inlines the json document into the statement text
+#client side, so this bounds the size of the SQL sent (about 30 bytes per key) and matches one cursor batch
+COMPLETION_MERGE_CHUNK_ROWS = GLUE_FETCH_BATCH_ROWS
+
+#Record this run's outcome for every selected row with one set-based MERGE per chunk on the existing connection
+#Completed rows are flagged, the rest count an attempt and are scheduled for a later run with exponential backoff
+#The keys are passed as a single json array and flattened server side, so no temp table or second connection is needed
+def record_assoc_attempts(completed_subscriptions, pending_subscriptions):
+    completed_subscriptions = set(map(str, completed_subscriptions))
+    outcomes = [{'s': key, 'ok': True} for key in completed_subscriptions]
+    outcomes += [{'s': key, 'ok': False} for key in dict.fromkeys(map(str, pending_subscriptions)) if key not in completed_subscriptions]
+
+    started = time.perf_counter()
+    rows_updated = 0
+    cs = ctx.cursor()
+    for i in range(0, len(outcomes), COMPLETION_MERGE_CHUNK_ROWS):
+        merge_sql = f"""
+        MERGE INTO "{snowflake_fivetran_db}"."{snowflake_schema}"."{table_name}" AS target
+        USING (
+            SELECT value:s::string AS AB_SUBSCRIPTION, value:ok::boolean AS OK
+            FROM TABLE(FLATTEN(input => PARSE_JSON(%s)))
+        ) AS staging
+        ON target.AB_SUBSCRIPTION = staging.AB_SUBSCRIPTION
+        WHEN MATCHED AND staging.OK THEN
+            UPDATE SET target.AB_CONTRACT_ASSOC_COMPLETE = TRUE,
+                target.ASSOC_ATTEMPTS = target.ASSOC_ATTEMPTS + 1,
+                target.NEXT_ATTEMPT_AT = NULL
+        WHEN MATCHED THEN
+            UPDATE SET target.ASSOC_ATTEMPTS = target.ASSOC_ATTEMPTS + 1,
+                target.NEXT_ATTEMPT_AT = DATEADD(minute, LEAST(%s * POWER(2, target.ASSOC_ATTEMPTS), %s), CURRENT_TIMESTAMP()::TIMESTAMP_NTZ)
+        """
+        document = json.dumps(outcomes[i:i + COMPLETION_MERGE_CHUNK_ROWS])
+        with span('snowflake', kind='System') as current:
+            cs.execute(merge_sql, (document, ASSOC_RETRY_BASE_MINUTES, ASSOC_RETRY_MAX_MINUTES))
+            current['bytes'] = len(merge_sql) + len(document)
+        rows_updated += cs.rowcount
+    print(f"Completion MERGE: {len(completed_subscriptions)} completed, {len(outcomes) - len(completed_subscriptions)} rescheduled, {rows_updated} rows updated in {time.perf_counter() - started:.2f}s")
+    return rows_updated
+
+#Stream the join result in cursor batches, rows arrive ordered by subscription and one subscription's contracts are never split across batches
+def iter_row_batches(cursor, batch_rows):
+    carry = []
+    while True:
+        with span('fetch_batch'), span('snowflake', kind='System'):
+            rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            if carry:
+                yield carry
+            return
+        rows = carry + rows
+        last_subscription = rows[-1][1]
+        split = len(rows)
+        while split > 0 and rows[split - 1][1] == last_subscription:
+            split -= 1
+        carry = rows[split:]
+        if split:
+            yield rows[:split]
+
+#Contract PATCHes to send for a batch of join rows, the contracts whose replicated text_field_2 already holds the subscription,
+#and every subscription the batch selected
+def plan_batch(rows):
+    items = []
+    unchanged = []
+    pending_subscriptions = []
+    for contract_id, ab_subscription, ab_reference, text_field_2 in rows:
+        pending_subscriptions.append(ab_subscription)
+        if contract_id is None:
+            continue
+        item = {
+            'id': contract_id,
+            'text_field2': ab_subscription
+        }
+        #Nothing to write when Core already has the value, compared as text since the replica may type either side differently
+        if text_field_2 is not None and str(text_field_2).strip() == str(ab_subscription).strip():
+            unchanged.append(item)
+        else:
+            items.append(item)
+    return items, unchanged, pending_subscriptions
+
+#Match every due staging row to its Core contracts in one server-side join, within the INSERTED_AT window so the scan prunes to recent partitions
+#Rows whose account has no cashe contract in Core yet come back with a null contract_id, so they are rescheduled without a PATCH
+cs = ctx.cursor()
+script = f"""
+select
+m.contract_id,
+s.ab_subscription,
+s.ab_reference,
+m.text_field_2
+from "{snowflake_fivetran_db}"."{snowflake_schema}"."{table_name}" s
+left join (
+    select
+    c.id as contract_id,
+    o.number as sf_act_id,
+    c.text_field_2
+    from "{snowflake_fivetran_db}"."{snowflake_schema}"."CONTRACT" c
+    inner join "{snowflake_fivetran_db}"."{snowflake_schema}"."CUSTOMER" o on o.id = c.customer_id
+    inner join "{snowflake_fivetran_db}"."{snowflake_schema}"."REGISTER" r on c.register_id = r.id
+    where lower(r.name) like %s
+) m on m.sf_act_id = s.ab_reference
+where s.ab_contract_assoc_complete = false
+and s.inserted_at >= dateadd(day, -%s, current_timestamp()::timestamp_ntz)
+and (s.next_attempt_at is null or s.next_attempt_at <= current_timestamp()::timestamp_ntz)
+and s.assoc_attempts < %s
+order by s.ab_subscription
+"""
+with span('select_due_rows'), span('snowflake', kind='System'):
+    payload = cs.execute(script, (CORE_REGISTER_NAME_PATTERN, ASSOC_MAX_AGE_DAYS, ASSOC_MAX_ATTEMPTS))
+
+#Each cursor batch flows into PATCHes and then its completion MERGE, so the first PATCH goes out as soon as the first batch arrives
+started = time.perf_counter()
+totals = {'batches': 0, 'rows': 0, 'skipped': 0, 'changed': 0, 'failed': 0, 'completed': 0}
+bucket = TokenBucket(CORE_RATE_PER_SECOND, CORE_RATE_BURST)
+with ThreadPoolExecutor(max_workers=CORE_MAX_WORKERS) as executor:
+    for rows in iter_row_batches(payload, GLUE_FETCH_BATCH_ROWS):
+        with span('plan_batch'):
+            items, unchanged, pending_subscriptions = plan_batch(rows)
+        with span('patch_contracts'):
+            succeeded, failed = patch_contracts(items, executor, bucket)
+
+        #Only subscriptions whose every contract Core already had or confirmed with a 2xx are complete, the rest are retried after their backoff
+        failed_subscriptions = {item['text_field2'] for item, error in failed}
+        completed_subscriptions = {item['text_field2'] for item in succeeded + unchanged if item['text_field2'] not in failed_subscriptions}
+        with span('completion_merge'):
+            record_assoc_attempts(completed_subscriptions, pending_subscriptions)
+
+        totals['batches'] += 1
+        totals['rows'] += len(rows)
+        totals['skipped'] += len(unchanged)
+        totals['changed'] += len(succeeded)
+        totals['failed'] += len(failed)
+        totals['completed'] += len(completed_subscriptions)
+
+print(f"Core PATCH: {totals} in {time.perf_counter() - started:.2f}s")
+print(f"HTTP connection reuse: {http_session_stats()}")
+flush_metrics({'Rows': totals['rows'], 'Skipped': totals['skipped'], 'Changed': totals['changed'], 'Failed': totals['failed']})
@@ -0,0 +1,23 @@
+-- Incremental processing for INTEGRATION_STAGING
+--
+-- Run once against the integration's database and schema before deploying the Lambda and Glue job
+-- that write and read these columns.
+--
+-- AB_CONTRACT_ASSOC_COMPLETE becomes a BOOLEAN so the pending filter needs no lower() and can prune.
+-- INSERTED_AT bounds how far back the Glue job looks, ASSOC_ATTEMPTS and NEXT_ATTEMPT_AT schedule
+-- retries with backoff so rows Core has not replicated yet are not re-driven on every run.
+
+ALTER TABLE INTEGRATION_STAGING ADD COLUMN AB_CONTRACT_ASSOC_COMPLETE_BOOL BOOLEAN DEFAULT FALSE;
+UPDATE INTEGRATION_STAGING SET AB_CONTRACT_ASSOC_COMPLETE_BOOL = (lower(AB_CONTRACT_ASSOC_COMPLETE) = 'true');
+ALTER TABLE INTEGRATION_STAGING DROP COLUMN AB_CONTRACT_ASSOC_COMPLETE;
+ALTER TABLE INTEGRATION_STAGING RENAME COLUMN AB_CONTRACT_ASSOC_COMPLETE_BOOL TO AB_CONTRACT_ASSOC_COMPLETE;
+
+-- Snowflake only allows constant defaults on added columns, the Lambda sets INSERTED_AT on every insert
+ALTER TABLE INTEGRATION_STAGING ADD COLUMN INSERTED_AT TIMESTAMP_NTZ;
+UPDATE INTEGRATION_STAGING SET INSERTED_AT = CURRENT_TIMESTAMP()::TIMESTAMP_NTZ WHERE INSERTED_AT IS NULL;
+
+ALTER TABLE INTEGRATION_STAGING ADD COLUMN ASSOC_ATTEMPTS NUMBER DEFAULT 0;
+ALTER TABLE INTEGRATION_STAGING ADD COLUMN NEXT_ATTEMPT_AT TIMESTAMP_NTZ;
+
+-- Rows arrive in INSERTED_AT order, clustering on it keeps the Glue job's window scan to recent micro-partitions
+ALTER TABLE INTEGRATION_STAGING CLUSTER BY (INSERTED_AT);
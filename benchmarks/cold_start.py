@@ -0,0 +1,63 @@
+#Cold start and per-event cost of the Lambda handler module
+#
+#Imports casheusagehandler in fresh interpreters to measure import time and peak RSS (what a cold
+#container pays before the first event), lists which heavy modules that import pulled in, and times
+#the Salesforce -> AB transformation for the sample fixture.
+#
+#   python benchmarks/cold_start.py --runs 5
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIR = os.path.join(ROOT, 'lambda-function')
+FIXTURE = os.path.join(ROOT, 'tools', 'fixtures', 'sample_opportunity.json')
+
+HEAVY_MODULES = ['pandas', 'numpy', 'advancedbilling', 'sqlalchemy', 'cryptography', 'boto3']
+
+IMPORT_PROBE = f"""
+import json, resource, sys, time
+sys.path.insert(0, {LAMBDA_DIR!r})
+started = time.perf_counter()
+import casheusagehandler
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    'import_seconds': elapsed,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'loaded': [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+}}))
+"""
+
+#Import the handler in a fresh interpreter, the closest local stand-in for a cold container
+def measure_import():
+    output = subprocess.run([sys.executable, '-c', IMPORT_PROBE], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure Lambda cold start and per-event transformation cost')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    samples = [measure_import() for _ in range(args.runs)]
+    print(f"import casheusagehandler: {min(s['import_seconds'] for s in samples) * 1000:.0f} ms (best of {args.runs})")
+    print(f"peak RSS after import:    {min(s['max_rss_mb'] for s in samples):.1f} MB")
+    print(f"heavy modules loaded:     {', '.join(samples[0]['loaded']) or 'none'}")
+
+    sys.path.insert(0, LAMBDA_DIR)
+    import casheusagehandler as handler
+
+    with open(FIXTURE) as f:
+        fixtures = json.load(f)
+    order = fixtures['Order'][0]
+    account = fixtures['Account'][0]
+
+    def event():
+        consumption_tiers = handler.build_consumption_tiers(order, account)
+        handler.build_price_tiers(consumption_tiers)
+        return (consumption_tiers[0].account_id, '12345678', False)
+
+    per_event = min(timeit.repeat(event, number=100, repeat=5)) / 100
+    print(f"per-event transformation: {per_event * 1000:.3f} ms")
@@ -0,0 +1,79 @@
+#Micro-benchmark for the Lambda's consumption tier builder
+#
+#Builds synthetic consumption schedules (several products, thousands of shuffled tiers each), checks that
+#build_price_tiers matches the original per-row pandas .iloc loop, and times both. pandas is only needed
+#here for the baseline, the Lambda itself no longer uses it.
+#
+#   python benchmarks/tier_builder.py --products 6 --tiers 5000 --repeat 5
+import argparse
+import os
+import random
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-function'))
+
+from advancedbilling.models.price import Price
+from casheusagehandler import ConsumptionTier, build_price_tiers
+
+#Synthetic consumption tiers in shuffled order, the records the handler builds from Salesforce
+def synthetic_schedules(products, tiers, seed=7):
+    rng = random.Random(seed)
+    records = []
+    for p in range(products):
+        for t in range(tiers):
+            records.append(ConsumptionTier(
+                f"802{p:015d}", f"01t{p:015d}", f"a1c{p:015d}", f"Tier {t}",
+                float(t * 100 + 1), round(rng.uniform(0.1, 5.0), 4),
+                '001000000000001AAA', 'Benchmark Account', f"Product {p}"))
+    rng.shuffle(records)
+    return records
+
+#The same tiers as the DataFrame the handler used to build
+def as_dataframe(records):
+    return pd.DataFrame([{'ProductName': r.product_name, 'LowerBound': r.lower_bound, 'PricePer': r.price_per} for r in records])
+
+#The original scalar loop, one product at a time, kept here as the baseline
+def build_price_tiers_iloc(final_salesforce_df):
+    tiers = {}
+    for product in final_salesforce_df['ProductName'].unique():
+        df = final_salesforce_df[final_salesforce_df['ProductName'] == product].sort_values('LowerBound', kind='stable')
+        prices_list = []
+        for i in range(len(df) - 1):
+            prices_list.append(Price(
+                starting_quantity=str(df['LowerBound'].iloc[i]),
+                ending_quantity=str(df['LowerBound'].iloc[i + 1] - 1),
+                unit_price=str(df['PricePer'].iloc[i])
+            ))
+        prices_list.append(Price(
+            starting_quantity=str(df['LowerBound'].iloc[-1]),
+            ending_quantity=None,
+            unit_price=str(df['PricePer'].iloc[-1])
+        ))
+        tiers[product] = prices_list
+    return tiers
+
+def as_tuples(tiers):
+    return {product: [(p.starting_quantity, p.ending_quantity, p.unit_price) for p in prices] for product, prices in tiers.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the consumption tier builder')
+    parser.add_argument('--products', type=int, default=6)
+    parser.add_argument('--tiers', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    records = synthetic_schedules(args.products, args.tiers)
+    df = as_dataframe(records)
+
+    if as_tuples(build_price_tiers(records)) != as_tuples(build_price_tiers_iloc(df)):
+        sys.exit('build_price_tiers output differs from the .iloc baseline')
+
+    current = min(timeit.repeat(lambda: build_price_tiers(records), number=1, repeat=args.repeat))
+    baseline = min(timeit.repeat(lambda: build_price_tiers_iloc(df), number=1, repeat=args.repeat))
+
+    print(f"{args.products} products x {args.tiers} tiers ({len(records)} rows)")
+    print(f"  .iloc loop:        {baseline * 1000:10.1f} ms")
+    print(f"  build_price_tiers: {current * 1000:10.1f} ms  ({baseline / current:.1f}x)")
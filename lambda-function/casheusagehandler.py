@@ -1,736 +1,1737 @@
+import builtins
+import sys
+import time
+import os
+
+#Startup profiling: record how long each module takes to import the first time (inclusive, like -X importtime)
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE', 'false').lower() == 'true'
+
+#Import timings not yet reported, module name -> seconds
+import_timings = {}
+_module_init_started = time.perf_counter()
+
+if STARTUP_PROFILE:
+    _builtin_import = builtins.__import__
+
+    def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+        #Resolve relative imports to the absolute module name
+        full_name = name
+        if level:
+            package = (globals or {}).get('__package__') or ''
+            base = package.rsplit('.', level - 1)[0] if level > 1 else package
+            full_name = f"{base}.{name}" if name else base
+        if full_name in sys.modules:
+            return _builtin_import(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        try:
+            return _builtin_import(name, globals, locals, fromlist, level)
+        finally:
+            import_timings.setdefault(full_name, time.perf_counter() - started)
+
+    builtins.__import__ = _profiled_import
+
 import requests
-import pandas as pd
-import boto3
+from urllib.parse import quote, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-import numpy as np
 import logging
 import random
 import json
-import time
-from advancedbilling.advanced_billing_client import AdvancedBillingClient
-from advancedbilling.http.auth.basic_auth import BasicAuthCredentials
-from advancedbilling.models.pricing_scheme import PricingScheme
-from advancedbilling.models.price import Price
-from advancedbilling.models.create_subscription_request import CreateSubscription,CreateSubscriptionRequest
-from advancedbilling.models.create_customer_request import CreateCustomer,CreateCustomerRequest
-from advancedbilling.models.create_component_price_point_request import CreateComponentPricePointRequest
-from advancedbilling.models.create_component_price_point import CreateComponentPricePoint
-from advancedbilling.models.create_subscription_component import CreateSubscriptionComponent
-import io
-from io import BytesIO
-from sqlalchemy import create_engine
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from dataclasses import dataclass
+import hashlib
+from decimal import Decimal
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from contextlib import contextmanager
+
+#The AB SDK, SQLAlchemy, cryptography and boto3 are imported inside the functions that use them,
+#so invocations that exit early (no CASH products) never pay for loading them
 
 #Set up cloudwatch logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    print("Recieved event:", json.dumps(event,indent=2))
-    logger.info("Lambda function started")
-
+#Log the imports recorded since the last report, slowest first, when STARTUP_PROFILE is on
+#Timings are inclusive of nested imports, so they overlap and should not be summed
+def report_import_timings(stage, elapsed_seconds=None):
+    if not STARTUP_PROFILE or not import_timings:
+        return
+    timings = sorted(import_timings.items(), key=lambda item: item[1], reverse=True)
+    import_timings.clear()
+    report = {'stage': stage, 'import_ms': {name: round(seconds * 1000, 1) for name, seconds in timings[:25]}}
+    if elapsed_seconds is not None:
+        report['elapsed_ms'] = round(elapsed_seconds * 1000, 1)
+    logger.info(json.dumps(report))
+
+#CloudWatch Embedded Metric Format telemetry: duration, call count and payload bytes per stage and per downstream system
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'SFDC-MaxioAB-Integration')
+METRICS_SERVICE = 'casheusagehandler'
+
+#Append the records to this json-lines file instead of printing them for CloudWatch Logs, for running without AWS
+METRICS_FILE = os.environ.get('METRICS_FILE')
+
+#Totals since the last flush, (kind, name) -> metrics, kind is 'Stage' or 'System'
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+#Add one call to a stage's or downstream system's totals
+def record_metric(kind, name, seconds, payload_bytes=0):
+    with _metrics_lock:
+        totals = _metrics.setdefault((kind, name), {'Duration': 0.0, 'Calls': 0, 'Bytes': 0})
+        totals['Duration'] += seconds * 1000
+        totals['Calls'] += 1
+        totals['Bytes'] += payload_bytes
+
+#Time a block as one call of a stage, or of a downstream system with kind='System'
+#The span dict is yielded so the block can add the payload bytes it sent and received
+@contextmanager
+def span(name, kind='Stage'):
+    current = {'bytes': 0}
+    started = time.perf_counter()
     try:
-        #If the event is a string, parse it as JSON
-        if isinstance(event, str):
-            event = json.loads(event)
-
-        #Extract the body from the event
-        event_data = event["body"]
-
-        #Parse the body content
-        body = json.loads(event_data)
-
-        #Extract Opportunity_Id from the body
-        opportunity_id = body["Opportunity_Id"]
+        yield current
+    finally:
+        record_metric(kind, name, time.perf_counter() - started, current['bytes'])
+
+#Emit one EMF record per stage and per system seen since the last flush
+def flush_metrics(properties=None):
+    with _metrics_lock:
+        totals = dict(_metrics)
+        _metrics.clear()
+    timestamp = int(time.time() * 1000)
+
+    lines = []
+    for (kind, name), values in sorted(totals.items()):
+        record = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Service', kind]],
+                    'Metrics': [
+                        {'Name': 'Duration', 'Unit': 'Milliseconds'},
+                        {'Name': 'Calls', 'Unit': 'Count'},
+                        {'Name': 'Bytes', 'Unit': 'Bytes'}
+                    ]
+                }]
+            },
+            'Service': METRICS_SERVICE,
+            kind: name,
+            'Duration': round(values['Duration'], 1),
+            'Calls': values['Calls'],
+            'Bytes': values['Bytes']
+        }
+        record.update(properties or {})
+        lines.append(json.dumps(record))
+
+    if not lines:
+        return
+    if METRICS_FILE:
+        with open(METRICS_FILE, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        #Lambda ships stdout to CloudWatch Logs, which extracts the metrics from EMF records
+        print('\n'.join(lines), flush=True)
+
+#AB SDK hook that times every AB API call as the 'maxio_ab' system
+class AbMetricsCallBack:
+    def on_before_request(self, request):
+        request.metrics_started = time.perf_counter()
+
+    def on_after_response(self, http_response):
+        request = http_response.request
+        sent = len(json.dumps(request.parameters)) if request.parameters else 0
+        received = len(http_response.text or '')
+        record_metric('System', 'maxio_ab', time.perf_counter() - getattr(request, 'metrics_started', time.perf_counter()), sent + received)
+
+#Secrets required by the handler
+secret_names = ['sfdc_prod_client_id','sfdc_prod_client_secret','maxio_prod_ab_api_key','snowflake_bizops_user','snowflake_account','snowflake_key_pass','snowflake_bizops_wh','snowflake_fivetran_db','snowflake_bizops_role',
+                'sfdc_hostname','maxio_ab_domain']
+
+#AWS S3 Configuration
+s3_bucket = 'cashemaxiohandler-env'
+s3_key = 'BIZ_OPS_ETL_USER.p8'
+
+#How long warm containers reuse secrets, key material, engine and AB client before rebuilding them
+RESOURCE_TTL_SECONDS = int(os.environ.get('RESOURCE_TTL_SECONDS', '3600'))
+
+#Warm-container resource cache, populated once per container and reused across invocations
+_resources = {}
+
+#How long parsed secrets stay cached in memory before being fetched again
+SECRETS_TTL_SECONDS = int(os.environ.get('SECRETS_TTL_SECONDS', '3600'))
+
+#Where secrets come from: 'aws' (Secrets Manager), 'file' (LOCAL_SECRETS_FILE json) or 'env' (SECRET_<NAME> variables)
+SECRETS_SOURCE = os.environ.get('SECRETS_SOURCE', 'aws')
+
+#Parsed secrets cache, secret name -> (fetched_at, value)
+_secrets_cache = {}
+
+#Outbound HTTP connection pooling: per-host pool sizes, timeout and retry policy for 429/5xx
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '4'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', '30'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+
+#Keep-alive sessions, one per host
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+#Return the pooled keep-alive session for the host in url
+def get_http_session(url):
+    host = urlparse(url).netloc
+    with _http_sessions_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            retry = Retry(
+                total=HTTP_MAX_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=None,
+                respect_retry_after_header=True,
+                raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[host] = session
+    return session
+
+#Send a request over the pooled session for its host, timed as the downstream system (the host by default)
+def http_request(method, url, system=None, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT_SECONDS)
+    with span(system or urlparse(url).netloc, kind='System') as current:
+        response = get_http_session(url).request(method, url, **kwargs)
+        current['bytes'] = len(response.request.body or b'') + len(response.content)
+    return response
+
+#Connections opened vs requests sent per host, a high ratio of requests to connections means keep-alive is working
+def http_session_stats():
+    stats = {}
+    with _http_sessions_lock:
+        for host, session in _http_sessions.items():
+            connections = 0
+            sent = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    connections += pool.num_connections
+                    sent += pool.num_requests
+            stats[host] = {'connections': connections, 'requests': sent}
+    return stats
+
+#Extract secret values from fetched secrets
+def extract_secret_value(data):
+    if isinstance(data, str):
+        return json.loads(data)
+    return data
+
+#Fetch secrets from secrets manager, batching up to 20 names per call
+def fetch_secrets_aws(secret_names, region_name):
+    import boto3
+
+    secrets = {}
+
+    client = boto3.client(
+        service_name='secretsmanager',
+        region_name=region_name
+    )
+
+    for i in range(0, len(secret_names), 20):
+        response = client.batch_get_secret_value(SecretIdList=secret_names[i:i + 20])
+        if response.get('Errors'):
+            raise RuntimeError(f"Error fetching secrets: {response['Errors']}")
+        for secret in response['SecretValues']:
+            if 'SecretString' in secret:
+                secrets[secret['Name']] = secret['SecretString']
+            else:
+                secrets[secret['Name']] = base64.b64decode(secret['SecretBinary'])
+
+    return secrets
+
+#Local stand-in for secrets manager so the pipeline can run offline
+def fetch_secrets_local(secret_names):
+    stored = {}
+    if SECRETS_SOURCE == 'file':
+        with open(os.environ['LOCAL_SECRETS_FILE']) as f:
+            stored = json.load(f)
+
+    secrets = {}
+    for secret_name in secret_names:
+        value = stored.get(secret_name, os.environ.get(f"SECRET_{secret_name.upper()}"))
+        if value is None:
+            raise KeyError(f"Secret {secret_name} not found in local secrets")
+        secrets[secret_name] = value if isinstance(value, str) else json.dumps(value)
+
+    return secrets
+
+#Load secrets, fetching only the missing or expired ones in a single batch and caching the parsed values
+def get_secrets(secret_names, region_name="us-east-1"):
+    now = time.time()
+    missing = [name for name in secret_names if name not in _secrets_cache or now - _secrets_cache[name][0] > SECRETS_TTL_SECONDS]
+
+    if missing:
+        with span('secretsmanager', kind='System'):
+            if SECRETS_SOURCE == 'aws':
+                fetched = fetch_secrets_aws(missing, region_name)
+            else:
+                fetched = fetch_secrets_local(missing)
+        for secret_name, value in fetched.items():
+            _secrets_cache[secret_name] = (now, extract_secret_value(value))
+
+    return {name: _secrets_cache[name][1] for name in secret_names}
+
+#Function to download file from S3
+def download_from_s3(bucket, key):
+    import boto3
+
+    s3_client = boto3.client('s3')
+    try:
+        with span('s3', kind='System') as current:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            body = response['Body'].read()
+            current['bytes'] = len(body)
+        return body
+    except Exception as e:
+        print(f"Error downloading from S3: {e}")
+        return None
+
+#Load the secrets every invocation needs, the engine and AB client are built on first use
+def load_resources():
+    extracted_secrets = get_secrets(secret_names)
+
+    return {
+        'secrets': extracted_secrets,
+        'sfdc_prod_client_id': extracted_secrets['sfdc_prod_client_id']['sfdc_prod_client_id'],
+        'sfdc_prod_secret_id': extracted_secrets['sfdc_prod_client_secret']['sfdc_prod_client_secret'],
+        'sfdc_hostname': extracted_secrets['sfdc_hostname']['sfdc_hostname'],
+        'loaded_at': time.time()
+    }
+
+#Decode the Snowflake key and build the SQLAlchemy engine
+def build_engine(extracted_secrets):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+    from sqlalchemy import create_engine
+
+    snowflake_user = extracted_secrets['snowflake_bizops_user']['snowflake_bizops_user']
+    snowflake_account = extracted_secrets['snowflake_account']['snowflake_account']
+    snowflake_key_pass = extracted_secrets['snowflake_key_pass']['snowflake_key_pass']
+    snowflake_bizops_wh = extracted_secrets['snowflake_bizops_wh']['snowflake_bizops_wh']
+    snowflake_schema = 'MAXIO_SAASOPTICS'
+    snowflake_fivetran_db = extracted_secrets['snowflake_fivetran_db']['snowflake_fivetran_db']
+    snowflake_role = extracted_secrets['snowflake_bizops_role']['snowflake_bizops_role']
+
+    password = snowflake_key_pass.encode()
+
+    #Call download from S3 function, download the private key file
+    key_data = download_from_s3(s3_bucket, s3_key)
+
+    #Load the private key as PEM
+    private_key = load_pem_private_key(key_data, password=password)
+
+    #Extract the private key bytes in PKCS8 format
+    private_key_bytes = private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption())
+
+    #Construct the SQLAlchemy connection string
+    connection_string = f"snowflake://{snowflake_user}@{snowflake_account}/{snowflake_fivetran_db}/{snowflake_schema}?warehouse={snowflake_bizops_wh}&role={snowflake_role}&authenticator=externalbrowser"
+
+    #Instantiate SQLAlchemy engine with the private key, its pool is reused while the container is warm
+    return create_engine(
+        connection_string,
+        connect_args={
+            "private_key": private_key_bytes
+        }
+    )
+
+#Build the AB client
+def build_ab_client(extracted_secrets):
+    from advancedbilling.advanced_billing_client import AdvancedBillingClient
+    from advancedbilling.http.auth.basic_auth import BasicAuthCredentials
+
+    maxio_prod_api_key = extracted_secrets['maxio_prod_ab_api_key']['maxio_prod_ab_api_key']
+    maxio_ab_domain = extracted_secrets['maxio_ab_domain']['maxio_ab_domain']
+
+    #Instantiatite the AB client
+    return AdvancedBillingClient(
+        basic_auth_credentials=BasicAuthCredentials(
+            username=maxio_prod_api_key,
+            password='x'
+        ),
+        subdomain=maxio_ab_domain,
+        domain='chargify.com',
+        #Back off and retry reads when AB rate limits us, the SDK's default methods leave POSTs out because it also
+        #retries timeouts and dropped connections, which could create a customer or subscription twice; ab_write resends POSTs on 429 only
+        max_retries=HTTP_MAX_RETRIES,
+        retry_statuses=[429],
+        http_call_back=AbMetricsCallBack()
+    )
+
+#Seconds to wait before resending a write AB answered 429 to, from Retry-After when AB sends it
+def ab_retry_after_seconds(e, attempt):
+    headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+    retry_after = next((value for name, value in headers.items() if name.lower() == 'retry-after'), None)
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30) * random.uniform(0.5, 1)
+
+#Send an AB write, resending it only when AB answers 429
+#A 429 means AB rejected the write, unlike a timeout where it may already have been applied
+def ab_write(call, *args, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            attempt += 1
+            if getattr(e, 'response_code', None) != 429 or attempt > HTTP_MAX_RETRIES:
+                raise
+            delay = ab_retry_after_seconds(e, attempt)
+            logger.info(f"AB rate limited {getattr(call, '__name__', 'write')}, resending in {delay:.1f}s")
+            time.sleep(delay)
+
+#Return the cached resources, rebuilding them on a cold container or once the TTL has lapsed
+def get_resources():
+    if not _resources or time.time() - _resources['loaded_at'] > RESOURCE_TTL_SECONDS:
+        invalidate_resources()
+        _resources.update(load_resources())
+    return _resources
+
+#The cached SQLAlchemy engine, built on first use
+def get_engine():
+    resources = get_resources()
+    if 'engine' not in resources:
+        resources['engine'] = build_engine(resources['secrets'])
+    return resources['engine']
+
+#The cached AB client, built on first use
+def get_ab_client():
+    resources = get_resources()
+    if 'client' not in resources:
+        resources['client'] = build_ab_client(resources['secrets'])
+    return resources['client']
+
+#Drop the cached resources and secrets so the next call to get_resources rebuilds them from freshly fetched secrets
+def invalidate_resources():
+    engine = _resources.get('engine')
+    if engine is not None:
+        engine.dispose()
+    _resources.clear()
+    _secrets_cache.clear()
+    invalidate_sfdc_token()
+
+#Do the expensive setup ahead of the first real request (provisioned concurrency / warmers)
+def prime_resources():
+    get_resources()
+    get_engine()
+    get_ab_client()
+    get_sfdc_token()
+    logger.info("Resource cache primed")
+
+#How long a Salesforce access token is trusted when the token response carries no expiry
+SFDC_TOKEN_TTL_SECONDS = int(os.environ.get('SFDC_TOKEN_TTL_SECONDS', '1800'))
+
+#Refresh the Salesforce token this many seconds before it expires
+SFDC_TOKEN_REFRESH_MARGIN_SECONDS = 60
+
+#Salesforce API version used for every query
+SFDC_API_VERSION = 'v61.0'
+
+#Cached Salesforce access token and instance url, shared across warm invocations
+_sfdc_token = {}
+_sfdc_token_lock = threading.RLock()
+
+#Fetch the instance url and access token from Salesforce API
+def fetch_sfdc_token(resources):
+    token_url = f"{resources['sfdc_hostname']}/services/oauth2/token"
+
+    payload = {
+        'grant_type': 'client_credentials',
+        'client_id': resources['sfdc_prod_client_id'],
+        'client_secret': resources['sfdc_prod_secret_id']
+    }
+
+    response = http_request('POST', token_url, system='salesforce', data=payload)
+    response.raise_for_status()
+
+    token_response = response.json()
+    expires_in = int(token_response.get('expires_in', SFDC_TOKEN_TTL_SECONDS))
+
+    return {
+        'access_token': token_response.get('access_token'),
+        'instance_url': token_response.get('instance_url'),
+        'expires_at': time.time() + expires_in
+    }
+
+#Return a usable token, refreshing it near expiry or when the caller saw stale_token rejected
+def get_sfdc_token(stale_token=None):
+    def usable():
+        return (_sfdc_token
+                and time.time() < _sfdc_token['expires_at'] - SFDC_TOKEN_REFRESH_MARGIN_SECONDS
+                and _sfdc_token['access_token'] != stale_token)
+
+    if usable():
+        return dict(_sfdc_token)
+
+    #Single-flight refresh, whoever gets the lock first refreshes and everyone else reuses the result
+    with _sfdc_token_lock:
+        if not usable():
+            token = fetch_sfdc_token(get_resources())
+            _sfdc_token.clear()
+            _sfdc_token.update(token)
+        return dict(_sfdc_token)
+
+#Forget the cached Salesforce token
+def invalidate_sfdc_token():
+    with _sfdc_token_lock:
+        _sfdc_token.clear()
+
+#Send a request to the Salesforce REST API with the cached token, refreshing it once if Salesforce answers 401
+#Paths starting with / (such as nextRecordsUrl) are taken relative to the instance url
+def sfdc_request(method, path, **kwargs):
+    token = get_sfdc_token()
+
+    def send(token):
+        if path.startswith('/'):
+            url = f"{token['instance_url']}{path}"
+        else:
+            url = f"{token['instance_url']}/services/data/{SFDC_API_VERSION}/{path}"
+        return http_request(
+            method,
+            url,
+            system='salesforce',
+            headers={
+                'Authorization': f"Bearer {token['access_token']}",
+                'Content-Type': 'application/json'
+            },
+            **kwargs)
+
+    response = send(token)
+    if response.status_code == 401:
+        response = send(get_sfdc_token(stale_token=token['access_token']))
+    response.raise_for_status()
+    return response
+
+#Run a SOQL query
+def sfdc_query(soql):
+    return sfdc_request('GET', 'query/', params={'q': soql})
+
+#Largest IN-list sent in one query, keeps the SOQL well under the URL length limit
+SOQL_IN_CHUNK_SIZE = int(os.environ.get('SOQL_IN_CHUNK_SIZE', '200'))
+
+#How many chunked queries run at once
+SOQL_MAX_WORKERS = int(os.environ.get('SOQL_MAX_WORKERS', '4'))
+
+#Stream a query's records page by page, following nextRecordsUrl
+def iter_query(soql):
+    body = sfdc_query(soql).json()
+    while True:
+        yield from body.get('records', [])
+        if body.get('done', True):
+            return
+        body = sfdc_request('GET', body['nextRecordsUrl']).json()
+
+#Stream the records of a nested relationship result, following its nextRecordsUrl when Salesforce paged it
+def iter_child_records(parent, relationship):
+    body = parent.get(relationship) or {}
+    while True:
+        yield from body.get('records', [])
+        if body.get('done', True):
+            return
+        body = sfdc_request('GET', body['nextRecordsUrl']).json()
+
+#Stream records whose field is in ids, splitting ids into URL-safe chunks that run concurrently
+#At most SOQL_MAX_WORKERS chunks are in flight, so memory stays bounded by the chunk size
+def iter_query_in(sobject, field, ids, subqueries=()):
+    ids = list(dict.fromkeys(ids))
+    chunks = iter([ids[i:i + SOQL_IN_CHUNK_SIZE] for i in range(0, len(ids), SOQL_IN_CHUNK_SIZE)])
+
+    def run(chunk):
+        id_list = ','.join(f"'{record_id}'" for record_id in chunk)
+        return list(iter_query(build_soql(sobject, f"{field} IN ({id_list})", subqueries)))
+
+    with ThreadPoolExecutor(max_workers=SOQL_MAX_WORKERS) as executor:
+        pending = {executor.submit(run, chunk) for chunk in itertools.islice(chunks, SOQL_MAX_WORKERS)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+                next_chunk = next(chunks, None)
+                if next_chunk:
+                    pending.add(executor.submit(run, next_chunk))
+
+#Run several dependent requests in a single composite round trip, subrequests can reference earlier results with @{referenceId.path}
+#optional names the subrequests allowed to fail (such as a reference to a null field), their result is {} instead of an error
+def sfdc_composite(subrequests, optional=()):
+    response = sfdc_request('POST', 'composite', json={'allOrNone': False, 'compositeRequest': subrequests})
+
+    results = {}
+    for result in response.json()['compositeResponse']:
+        if result['httpStatusCode'] >= 400:
+            if result['referenceId'] not in optional:
+                raise RuntimeError(f"Salesforce composite subrequest {result['referenceId']} failed: {result['body']}")
+            logger.info(f"Salesforce composite subrequest {result['referenceId']} returned nothing: {result['body']}")
+            results[result['referenceId']] = {}
+            continue
+        results[result['referenceId']] = result['body']
+    return results
+
+#Build a composite subrequest for a SOQL query, leaving @{...} references intact for Salesforce to resolve
+def composite_query(reference_id, soql):
+    return {
+        'method': 'GET',
+        'referenceId': reference_id,
+        'url': f"/services/data/{SFDC_API_VERSION}/query/?q={quote(' '.join(soql.split()), safe='@{}[]')}"
+    }
+
+#Readiness poll for the CPQ order: first delay, backoff ceiling and overall deadline, in seconds
+ORDER_POLL_INITIAL_DELAY_SECONDS = float(os.environ.get('ORDER_POLL_INITIAL_DELAY_SECONDS', '1'))
+ORDER_POLL_MAX_DELAY_SECONDS = float(os.environ.get('ORDER_POLL_MAX_DELAY_SECONDS', '8'))
+ORDER_POLL_DEADLINE_SECONDS = float(os.environ.get('ORDER_POLL_DEADLINE_SECONDS', '120'))
+
+#Seconds of the Lambda's remaining time kept back from the poll for the AB work, the poll always gets at least half of what remains
+ORDER_POLL_RESERVE_SECONDS = float(os.environ.get('ORDER_POLL_RESERVE_SECONDS', '60'))
+
+#Child relationship names used by the order graph subqueries
+ORDER_ITEMS_RELATIONSHIP = 'OrderItems'
+CONSUMPTION_SCHEDULES_RELATIONSHIP = 'SBQQ__OrderItemConsumptionSchedules__r'
+CONSUMPTION_RATES_RELATIONSHIP = 'SBQQ__OrderItemConsumptionRates__r'
+
+#Fields selected from each sObject, queries are built from this registry instead of fields(ALL)
+SOQL_PROJECTIONS = {
+    'Opportunity': ['Id', 'AccountId', 'SBQQ__PrimaryQuote__c'],
+    'OpportunityLineItem': ['Product2Id', 'Product2.ProductCode', 'Product2.Name'],
+    'SBQQ__Quote__c': ['Id', 'SBQQ__PrimaryContact__c', 'SBQQ__PrimaryContact__r.Email'],
+    'Account': ['Id', 'Name', 'ia_crm__Email_ID__c', 'BillingStreet', 'BillingCity', 'BillingState', 'BillingPostalCode', 'BillingCountry', 'Phone'],
+    'Order': ['Id', 'SBQQ__Quote__c'],
+    'OrderItem': ['Id', 'Product2Id', 'Product2.Name'],
+    'SBQQ__OrderItemConsumptionSchedule__c': ['Id'],
+    'SBQQ__OrderItemConsumptionRate__c': ['SBQQ__OrderItemConsumptionSchedule__c', 'Name', 'SBQQ__LowerBound__c', 'SBQQ__Price__c']
+}
+
+#Read a field from a Salesforce record, dotted names follow parent relationships (Product2.Name)
+#Every record field read goes through here, so reading a field SOQL_PROJECTIONS never selects fails loudly instead of returning None
+def record_field(sobject, record, field):
+    if field not in SOQL_PROJECTIONS[sobject]:
+        raise ValueError(f"{sobject}.{field} is read but not in SOQL_PROJECTIONS")
+    value = record
+    for part in field.split('.'):
+        value = (value or {}).get(part)
+    return value
+
+#Build a SOQL query from the projection registry, from_name is the child relationship name for subqueries
+def build_soql(sobject, where=None, subqueries=(), from_name=None):
+    columns = SOQL_PROJECTIONS[sobject] + [f"({subquery})" for subquery in subqueries]
+    soql = f"SELECT {', '.join(columns)} FROM {from_name or sobject}"
+    if where:
+        soql += f" WHERE {where}"
+    return soql
+
+#Collapse whitespace so equivalent SOQL strings share a cache key
+def normalize_soql(soql):
+    return ' '.join(soql.split())
+
+#Request-scoped SOQL memo, identical queries and already-fetched record ids are served without a round trip
+class QueryCache:
+    def __init__(self):
+        self.results = {}
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+    #Index top-level records by (sObject, Id) so later id lookups can reuse them
+    def index(self, sobject, records):
+        if sobject is None:
+            return
+        for record in records:
+            record_id = record_field(sobject, record, 'Id')
+            if record_id:
+                self.records[(sobject, record_id)] = record
+
+    #Run a SOQL query once per invocation, the response body is decoded exactly once; fresh=True always goes to Salesforce
+    def query(self, soql, sobject=None, fresh=False):
+        key = normalize_soql(soql)
+        if not fresh and key in self.results:
+            self.hits += 1
+            return self.results[key]
+
+        self.misses += 1
+        records = list(iter_query(key))
+        body = {'totalSize': len(records), 'done': True, 'records': records}
+        self.results[key] = body
+        self.index(sobject, records)
+        return body
+
+    #Run a composite request once per invocation, sobjects maps referenceId to the sObject each subrequest returns
+    def composite(self, subrequests, sobjects=None, optional=()):
+        key = json.dumps([subrequest['url'] for subrequest in subrequests])
+        if key in self.results:
+            self.hits += 1
+            return self.results[key]
+
+        self.misses += 1
+        results = sfdc_composite(subrequests, optional)
+        self.results[key] = results
+        for reference_id, sobject in (sobjects or {}).items():
+            self.index(sobject, results[reference_id].get('records', []))
+        return results
+
+    #Fetch records by id, only the ids not already fetched in this invocation are queried
+    def fetch_by_ids(self, sobject, ids):
+        ids = list(dict.fromkeys(ids))
+        missing = [record_id for record_id in ids if (sobject, record_id) not in self.records]
+        self.hits += len(ids) - len(missing)
+
+        if missing:
+            self.misses += 1
+            self.index(sobject, iter_query_in(sobject, 'Id', missing))
+
+        return [self.records[(sobject, record_id)] for record_id in ids if (sobject, record_id) in self.records]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+#Fetch the opportunity with its line item products, the primary quote contact and the account in one round trip
+#An opportunity without a primary quote fails the quote subrequest, which just leaves the quote empty
+def fetch_opportunity_graph(opportunity_id, cache):
+    results = cache.composite([
+        composite_query('opp', build_soql(
+            'Opportunity',
+            f"Id = '{opportunity_id}'",
+            subqueries=[build_soql('OpportunityLineItem', from_name='OpportunityLineItems')])),
+        composite_query('quote', build_soql('SBQQ__Quote__c', "Id = '@{opp.records[0].SBQQ__PrimaryQuote__c}'")),
+        composite_query('account', build_soql('Account', "Id = '@{opp.records[0].AccountId}'"))
+    ], sobjects={'opp': 'Opportunity', 'quote': 'SBQQ__Quote__c', 'account': 'Account'}, optional=('quote',))
+
+    opportunity = results['opp']['records'][0]
+
+    return {
+        'opportunity': opportunity,
+        'line_items': list(iter_child_records(opportunity, 'OpportunityLineItems')),
+        'quote': (results['quote'].get('records') or [{}])[0],
+        'account': results['account']['records'][0]
+    }
+
+#Fetch many opportunities with the same bulk IN queries, one per sObject rather than one composite per opportunity
+#Returns opportunity id -> the same graph fetch_opportunity_graph builds, ids Salesforce does not know are left out
+#A single id uses the composite round trip, which raises for an unknown id, unless bulk asks for the IN queries anyway
+def fetch_opportunity_graphs(opportunity_ids, cache, bulk=False):
+    opportunity_ids = list(dict.fromkeys(opportunity_ids))
+    if len(opportunity_ids) == 1 and not bulk:
+        return {opportunity_ids[0]: fetch_opportunity_graph(opportunity_ids[0], cache)}
+
+    line_items_query = build_soql('OpportunityLineItem', from_name='OpportunityLineItems')
+    opportunities = list(iter_query_in('Opportunity', 'Id', opportunity_ids, subqueries=[line_items_query]))
+    cache.index('Opportunity', opportunities)
+
+    quote_ids = [record_field('Opportunity', o, 'SBQQ__PrimaryQuote__c') for o in opportunities]
+    account_ids = [record_field('Opportunity', o, 'AccountId') for o in opportunities]
+    quotes = {record_field('SBQQ__Quote__c', record, 'Id'): record for record in cache.fetch_by_ids('SBQQ__Quote__c', [quote_id for quote_id in quote_ids if quote_id])}
+    accounts = {record_field('Account', record, 'Id'): record for record in cache.fetch_by_ids('Account', [account_id for account_id in account_ids if account_id])}
+
+    graphs = {}
+    for opportunity, quote_id, account_id in zip(opportunities, quote_ids, account_ids):
+        graphs[record_field('Opportunity', opportunity, 'Id')] = {
+            'opportunity': opportunity,
+            'line_items': list(iter_child_records(opportunity, 'OpportunityLineItems')),
+            'quote': quotes.get(quote_id, {}),
+            'account': accounts.get(account_id)
+        }
+    return graphs
+
+#Nested relationship subquery for an order's items, consumption schedules and rates
+def order_items_subquery():
+    rates_query = build_soql('SBQQ__OrderItemConsumptionRate__c', from_name=CONSUMPTION_RATES_RELATIONSHIP)
+    schedules_query = build_soql('SBQQ__OrderItemConsumptionSchedule__c', subqueries=[rates_query], from_name=CONSUMPTION_SCHEDULES_RELATIONSHIP)
+    return build_soql('OrderItem', subqueries=[schedules_query], from_name=ORDER_ITEMS_RELATIONSHIP)
+
+#Fetch the order for a quote with its order items, consumption schedules and rates in one relationship query
+def fetch_order_graph(primary_quote, cache):
+    #Always fresh, the readiness poll needs to see the order as CPQ builds it
+    records = cache.query(build_soql('Order', f"SBQQ__Quote__c = '{primary_quote}'", subqueries=[order_items_subquery()]), sobject='Order', fresh=True)['records']
+    return records[0] if records else None
+
+#Fetch the orders for many quotes in bulk IN queries, returns quote id -> order
+def fetch_order_graphs(primary_quotes, cache):
+    if len(primary_quotes) == 1:
+        return {primary_quote: fetch_order_graph(primary_quote, cache) for primary_quote in primary_quotes}
+    #Never served from the cache, same as the single order poll
+    orders = list(iter_query_in('Order', 'SBQQ__Quote__c', primary_quotes, subqueries=[order_items_subquery()]))
+    cache.index('Order', orders)
+    return {primary_quote: next((order for order in orders if record_field('Order', order, 'SBQQ__Quote__c') == primary_quote), None) for primary_quote in primary_quotes}
+
+#CPQ builds the order asynchronously, it is ready once every quote line has an order item and every consumption schedule has its rates
+#CPQ writes each product's schedule rates separately, so one schedule with rates does not mean the others are done
+def order_graph_ready(order, expected_item_count):
+    if order is None:
+        return False
+    items = order.get(ORDER_ITEMS_RELATIONSHIP) or {}
+    schedules = [
+        schedule
+        for item in items.get('records', [])
+        for schedule in (item.get(CONSUMPTION_SCHEDULES_RELATIONSHIP) or {}).get('records', [])]
+    has_rates = bool(schedules) and all((schedule.get(CONSUMPTION_RATES_RELATIONSHIP) or {}).get('totalSize', 0) > 0 for schedule in schedules)
+    return items.get('totalSize', 0) >= expected_item_count and has_rates
+
+#Poll for the order graph with exponential backoff and jitter until it is ready or the deadline passes
+def wait_for_order_graph(primary_quote, expected_item_count, cache, deadline_seconds=None):
+    if deadline_seconds is None:
+        deadline_seconds = ORDER_POLL_DEADLINE_SECONDS
+    started = time.monotonic()
+    delay = ORDER_POLL_INITIAL_DELAY_SECONDS
+    attempts = 0
+
+    while True:
+        attempts += 1
+        order = fetch_order_graph(primary_quote, cache)
+        waited = time.monotonic() - started
+        if order_graph_ready(order, expected_item_count):
+            logger.info(f"Order for quote {primary_quote} ready after {waited:.2f}s and {attempts} polls")
+            return order
+
+        remaining = deadline_seconds - waited
+        if remaining <= 0:
+            raise TimeoutError(f"Order for quote {primary_quote} not ready after {waited:.2f}s and {attempts} polls")
+
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+        delay = min(delay * 2, ORDER_POLL_MAX_DELAY_SECONDS)
+
+#Poll for many orders at once, each poll only asks for the quotes whose order is not ready yet
+#expected_item_counts maps quote id -> quote line count, returns quote id -> order for the ready ones
+#A single quote raises TimeoutError like wait_for_order_graph unless partial asks for whatever is ready at the deadline
+def wait_for_order_graphs(expected_item_counts, cache, deadline_seconds=None, partial=False):
+    if len(expected_item_counts) == 1 and not partial:
+        (primary_quote, expected_item_count), = expected_item_counts.items()
+        return {primary_quote: wait_for_order_graph(primary_quote, expected_item_count, cache, deadline_seconds)}
+
+    if deadline_seconds is None:
+        deadline_seconds = ORDER_POLL_DEADLINE_SECONDS
+    started = time.monotonic()
+    delay = ORDER_POLL_INITIAL_DELAY_SECONDS
+    attempts = 0
+    ready = {}
+
+    while True:
+        attempts += 1
+        waiting = [primary_quote for primary_quote in expected_item_counts if primary_quote not in ready]
+        for primary_quote, order in fetch_order_graphs(waiting, cache).items():
+            if order_graph_ready(order, expected_item_counts[primary_quote]):
+                ready[primary_quote] = order
+        waited = time.monotonic() - started
+
+        remaining = deadline_seconds - waited
+        if len(ready) == len(expected_item_counts) or remaining <= 0:
+            logger.info(f"{len(ready)} of {len(expected_item_counts)} orders ready after {waited:.2f}s and {attempts} polls")
+            return ready
+
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+        delay = min(delay * 2, ORDER_POLL_MAX_DELAY_SECONDS)
+
+#One consumption rate of one order item, the record the AB price tiers are built from
+@dataclass
+class ConsumptionTier:
+    __slots__ = ('order_line_id', 'product_id', 'cons_schedule_id', 'name', 'lower_bound', 'price_per', 'account_id', 'account_name', 'product_name')
+    order_line_id: str
+    product_id: str
+    cons_schedule_id: str
+    name: str
+    lower_bound: float
+    price_per: float
+    account_id: str
+    account_name: str
+    product_name: str
+
+#Flatten the order graph into one record per consumption rate (order item -> schedule -> rate, with the product and account joined on)
+#Order items without a consumption schedule, and rates missing any value, are left out
+def build_consumption_tiers(order, account):
+    tiers = []
+    for item in iter_child_records(order, ORDER_ITEMS_RELATIONSHIP):
+        product_name = record_field('OrderItem', item, 'Product2.Name')
+        for schedule in iter_child_records(item, CONSUMPTION_SCHEDULES_RELATIONSHIP):
+            for rate in iter_child_records(schedule, CONSUMPTION_RATES_RELATIONSHIP):
+                tier = ConsumptionTier(
+                    record_field('OrderItem', item, 'Id'),
+                    record_field('OrderItem', item, 'Product2Id'),
+                    record_field('SBQQ__OrderItemConsumptionSchedule__c', schedule, 'Id'),
+                    record_field('SBQQ__OrderItemConsumptionRate__c', rate, 'Name'),
+                    record_field('SBQQ__OrderItemConsumptionRate__c', rate, 'SBQQ__LowerBound__c'),
+                    record_field('SBQQ__OrderItemConsumptionRate__c', rate, 'SBQQ__Price__c'),
+                    record_field('Account', account, 'Id'),
+                    record_field('Account', account, 'Name'),
+                    product_name)
+                if all(getattr(tier, field) is not None for field in ConsumptionTier.__slots__):
+                    tiers.append(tier)
+    return tiers
+
+#Maxio AB component for each Salesforce product
+component_dictionary = {'Pavillio Subscription - Core Billing':'2544422','Pavillio Subscription - County Billing':'2544424',
+                        'Managed Billing Subscription':'2554766','Pavillio Per Client Fee':'2544421','Pavillio Platform - Basic':'2544427',
+                        'Pavillio Platform - Lite':'2544427','Billing Services Subscription (By Claim)': '2544425'}
+
+#How many price point requests are in flight against Maxio AB at once
+MAXIO_MAX_WORKERS = int(os.environ.get('MAXIO_MAX_WORKERS', '3'))
+
+#Build the Maxio AB price tiers for every product in one pass
+#Tiers are sorted by lower bound within each product, each tier ends one below the next tier's lower bound and the last tier is open ended
+def build_price_tiers(consumption_tiers):
+    from advancedbilling.models.price import Price
+
+    by_product = {}
+    for tier in sorted(consumption_tiers, key=lambda tier: (tier.product_name, tier.lower_bound)):
+        by_product.setdefault(tier.product_name, []).append(tier)
+
+    price_tiers = {}
+    for product, product_tiers in by_product.items():
+        next_bounds = [tier.lower_bound for tier in product_tiers[1:]] + [None]
+        #Build the dynamic Maxio AB price object
+        price_tiers[product] = [
+            Price(
+                starting_quantity=str(tier.lower_bound),
+                ending_quantity=None if next_bound is None else str(next_bound - 1),
+                unit_price=str(tier.price_per)
+            )
+            for tier, next_bound in zip(product_tiers, next_bounds)
+        ]
+    return price_tiers
+
+#S3 object holding the persisted price point index, and how long warm containers trust it and AB's price point listings
+PRICE_POINT_INDEX_KEY = 'price_point_index.json'
+PRICE_POINT_CACHE_TTL_SECONDS = int(os.environ.get('PRICE_POINT_CACHE_TTL_SECONDS', '3600'))
+
+#Content-addressed price point index, digest -> {'component_id', 'price_point_id', 'price_point_name'}
+_price_point_index = {'entries': {}, 'loaded_at': 0, 'dirty': False}
+
+#Existing price points listed from AB per component, component_id -> (fetched_at, {digest: entry})
+_component_price_points = {}
+
+#When each index entry was last confirmed live in AB, digest -> confirmed_at
+_verified_price_points = {}
+_price_point_lock = threading.Lock()
+
+#Render a quantity or price the same way whether it came from Salesforce or AB ('100', '100.0' and 100 all become '100')
+def normalize_price_value(value):
+    if value is None or value == '':
+        return None
+    return format(Decimal(str(value)).normalize(), 'f')
+
+#Content address of a price point: its component, pricing scheme and normalized tier list
+def price_point_digest(component_id, pricing_scheme, prices):
+    tiers = sorted(
+        ((normalize_price_value(price.starting_quantity), normalize_price_value(price.ending_quantity), normalize_price_value(price.unit_price))
+         for price in prices),
+        key=lambda tier: Decimal(tier[0] or 0))
+    key = json.dumps([str(component_id), str(pricing_scheme).lower(), tiers])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+#Load the persisted index from S3 once per TTL
+#Any load error (a missing object, or AccessDenied when the role cannot list the bucket) just means starting from an empty index,
+#the AB listing still finds existing price points and the next save creates the object
+def load_price_point_index():
+    if time.time() - _price_point_index['loaded_at'] <= PRICE_POINT_CACHE_TTL_SECONDS:
+        return
+    import boto3
 
-        #Load secrets from secrets manager
-        def get_secrets(secret_names, region_name="us-east-1"):
-            secrets = {}
-            
-            client = boto3.client(
-                service_name='secretsmanager',
-                region_name=region_name
+    try:
+        with span('s3', kind='System') as current:
+            body = boto3.client('s3').get_object(Bucket=s3_bucket, Key=PRICE_POINT_INDEX_KEY)['Body'].read()
+            current['bytes'] = len(body)
+        entries = json.loads(body)
+    except Exception as e:
+        logger.error(f"Error loading price point index, starting from an empty index: {e}")
+        entries = {}
+    _price_point_index['entries'].update(entries)
+    _price_point_index['loaded_at'] = time.time()
+
+#Write the index back to S3 if this invocation added to it
+def save_price_point_index():
+    with _price_point_lock:
+        if not _price_point_index['dirty']:
+            return
+        body = json.dumps(_price_point_index['entries'])
+        _price_point_index['dirty'] = False
+    import boto3
+
+    with span('s3', kind='System') as current:
+        boto3.client('s3').put_object(Bucket=s3_bucket, Key=PRICE_POINT_INDEX_KEY, Body=body.encode())
+        current['bytes'] = len(body)
+
+#Index every live price point already on a component by content address, cached per component for the TTL
+def list_component_price_point_digests(component_price_points_controller, component_id):
+    cached = _component_price_points.get(component_id)
+    if cached and time.time() - cached[0] <= PRICE_POINT_CACHE_TTL_SECONDS:
+        return cached[1]
+
+    digests = {}
+    page = 1
+    while True:
+        response = component_price_points_controller.list_component_price_points({
+            'component_id': int(component_id),
+            'page': page,
+            'per_page': 200
+        })
+        price_points = response.price_points or []
+        for price_point in price_points:
+            if price_point.archived_at is None and price_point.prices:
+                digest = price_point_digest(component_id, price_point.pricing_scheme, price_point.prices)
+                digests[digest] = {
+                    'component_id': component_id,
+                    'price_point_id': price_point.id,
+                    'price_point_name': price_point.name
+                }
+        if len(price_points) < 200:
+            break
+        page += 1
+
+    _component_price_points[component_id] = (time.time(), digests)
+    return digests
+
+#Check an index entry against AB, it must still exist unarchived with the same tiers, confirmed at most once per TTL
+def price_point_live(component_price_points_controller, digest, entry):
+    confirmed_at = _verified_price_points.get(digest)
+    if confirmed_at and time.time() - confirmed_at <= PRICE_POINT_CACHE_TTL_SECONDS:
+        return True
+    try:
+        price_point = component_price_points_controller.read_component_price_point(int(entry['component_id']), entry['price_point_id']).price_point
+    except Exception as e:
+        logger.info(f"Price point {entry['price_point_id']} could not be read, dropping it from the index: {e}")
+        return False
+    live = (price_point.archived_at is None and bool(price_point.prices)
+            and price_point_digest(entry['component_id'], price_point.pricing_scheme, price_point.prices) == digest)
+    if live:
+        _verified_price_points[digest] = time.time()
+    return live
+
+#Find an existing price point with this content address, first in our own index and then on the component itself
+#Index entries are confirmed live before reuse, so an archived or edited price point is evicted instead of failing the subscription
+def find_price_point(component_price_points_controller, component_id, digest):
+    with _price_point_lock:
+        load_price_point_index()
+        entry = _price_point_index['entries'].get(digest)
+    if entry:
+        if price_point_live(component_price_points_controller, digest, entry):
+            return entry
+        forget_price_point(digest)
+
+    entry = list_component_price_point_digests(component_price_points_controller, component_id).get(digest)
+    if entry:
+        remember_price_point(digest, entry)
+    return entry
+
+#Record a price point in the index so later deals with the same tiers reuse it, it is live in AB as of now
+def remember_price_point(digest, entry):
+    with _price_point_lock:
+        _price_point_index['entries'][digest] = entry
+        _price_point_index['dirty'] = True
+        _verified_price_points[digest] = time.time()
+
+#Drop a price point AB no longer has live from the index
+def forget_price_point(digest):
+    with _price_point_lock:
+        if _price_point_index['entries'].pop(digest, None) is not None:
+            _price_point_index['dirty'] = True
+        _verified_price_points.pop(digest, None)
+
+#Resolve a component price point per product on a bounded worker pool, reusing identical existing price points
+#and raising with every failure once all requests resolve
+def create_price_points(client, consumption_tiers):
+    from advancedbilling.models.pricing_scheme import PricingScheme
+    from advancedbilling.models.create_component_price_point_request import CreateComponentPricePointRequest
+    from advancedbilling.models.create_component_price_point import CreateComponentPricePoint
+
+    #Instantiate the component price points controller
+    component_price_points_controller = client.component_price_points
+
+    #Build every product's tiers at once
+    price_tiers = build_price_tiers(consumption_tiers)
+
+    def resolve(product, component_id):
+        prices_list = price_tiers[product]
+        digest = price_point_digest(component_id, PricingScheme.VOLUME, prices_list)
+
+        existing = find_price_point(component_price_points_controller, component_id, digest)
+        if existing:
+            return dict(existing, reused=True)
+
+        #Name the price point after its content address only, it is shared by every customer whose deal has these tiers
+        price_point_name = f"volume_{digest[:12]}"
+
+        price_point_body = CreateComponentPricePointRequest(
+            price_point=CreateComponentPricePoint(
+                name=price_point_name,
+                pricing_scheme=PricingScheme.VOLUME,
+                prices=prices_list,
+                use_site_exchange_rate=False
             )
-            
-            for secret_name in secret_names:
-                try:
-                    get_secret_value_response = client.get_secret_value(
-                        SecretId=secret_name)
-                except Exception as e:
-                        raise e
-                else:
-                    if 'SecretString' in get_secret_value_response:
-                        secrets[secret_name] = get_secret_value_response['SecretString']
-                    else:
-                        secrets[secret_name] = base64.b64decode(get_secret_value_response['SecretBinary'])
-
-            return secrets
-        #Extract secret values from fetched secrets
-        def extract_secret_value(data):
-            if isinstance(data, str):
-                return json.loads(data)
-            return data
-
-        secrets = ['sfdc_prod_client_id','sfdc_prod_client_secret','maxio_prod_ab_api_key','snowflake_bizops_user','snowflake_account','snowflake_key_pass','snowflake_bizops_wh','snowflake_fivetran_db','snowflake_bizops_role',
-                   'sfdc_hostname','maxio_ab_domain']
-
-        fetch_secrets = get_secrets(secrets)
-
-        extracted_secrets = {key: extract_secret_value(value) for key, value in fetch_secrets.items()}
-
-        sfdc_prod_client_id = extracted_secrets['sfdc_prod_client_id']['sfdc_prod_client_id']
-        sfdc_prod_secret_id = extracted_secrets['sfdc_prod_client_secret']['sfdc_prod_client_secret']
-        maxio_prod_api_key = extracted_secrets['maxio_prod_ab_api_key']['maxio_prod_ab_api_key']
-        snowflake_user = extracted_secrets['snowflake_bizops_user']['snowflake_bizops_user']
-        snowflake_account = extracted_secrets['snowflake_account']['snowflake_account']
-        snowflake_key_pass = extracted_secrets['snowflake_key_pass']['snowflake_key_pass']
-        snowflake_bizops_wh = extracted_secrets['snowflake_bizops_wh']['snowflake_bizops_wh']
-        snowflake_schema = 'MAXIO_SAASOPTICS'
-        snowflake_fivetran_db = extracted_secrets['snowflake_fivetran_db']['snowflake_fivetran_db']
-        snowflake_role = extracted_secrets['snowflake_bizops_role']['snowflake_bizops_role']
-        sfdc_hostname = extracted_secrets['sfdc_hostname']['sfdc_hostname']
-        maxio_ab_domain = extracted_secrets['maxio_ab_domain']['maxio_ab_domain']
-
-        password = snowflake_key_pass.encode()
-
-        #AWS S3 Configuration
-        s3_bucket = 'cashemaxiohandler-env'
-        s3_key = 'BIZ_OPS_ETL_USER.p8'
-
-        #Function to download file from S3
-        def download_from_s3(bucket, key):
-            s3_client = boto3.client('s3')
+        )
+        price_point_response = ab_write(
+            component_price_points_controller.create_component_price_point,
+            component_id,
+            body=price_point_body
+        )
+        entry = {
+            'component_id': component_id,
+            'price_point_id': price_point_response.price_point.id,
+            'price_point_name': price_point_name
+        }
+        remember_price_point(digest, entry)
+        return dict(entry, reused=False)
+
+    #Create a dictionary to store created price points
+    created_price_points = {}
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=MAXIO_MAX_WORKERS) as executor:
+        futures = {}
+        for product in price_tiers:
+            component_id = component_dictionary.get(product)
+            if component_id is None:
+                continue
+            futures[executor.submit(resolve, product, component_id)] = product
+
+        for future in as_completed(futures):
+            product = futures[future]
             try:
-                response = s3_client.get_object(Bucket=bucket, Key=key)
-                return response['Body'].read()
+                #Store the created price point in the dictionary for use later
+                created_price_points[product] = future.result()
             except Exception as e:
-                print(f"Error downloading from S3: {e}")
-                return None
-
-        #Call download from S3 function, download the private key file
-        key_data = download_from_s3(s3_bucket, s3_key)
-
-        #Loead the private key as PEM
-        private_key = load_pem_private_key(key_data, password=password)
+                failures[product] = str(e)
 
-        #Extract the private key bytes in PKCS8 format
-        private_key_bytes = private_key.private_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption())
-
-        #Construct the SQLAlchemy connection string
-        connection_string = f"snowflake://{snowflake_user}@{snowflake_account}/{snowflake_fivetran_db}/{snowflake_schema}?warehouse={snowflake_bizops_wh}&role={snowflake_role}&authenticator=externalbrowser"
+    #Persist whatever this invocation learned, even if some products failed
+    try:
+        save_price_point_index()
+    except Exception as e:
+        logger.error(f"Error saving price point index: {e}")
+
+    #Keep the product order stable regardless of which request finished first
+    created_price_points = {product: created_price_points[product] for product in futures.values() if product in created_price_points}
+    reused = sum(1 for details in created_price_points.values() if details['reused'])
+    logger.info(f"Price points: {reused} reused, {len(created_price_points) - reused} created")
+
+    if failures:
+        for product, error in failures.items():
+            logger.error(f"Failed to create price point for {product}: {error}")
+        raise RuntimeError(f"Failed to create price points for {sorted(failures)}")
+
+    return created_price_points
+
+#How long the Salesforce Account Id -> AB customer index seeded from INTEGRATION_STAGING is trusted
+CUSTOMER_INDEX_TTL_SECONDS = int(os.environ.get('CUSTOMER_INDEX_TTL_SECONDS', '3600'))
+
+#How long to wait after a failed seed before trying Snowflake again, lookups go straight to the AB search meanwhile
+CUSTOMER_INDEX_RETRY_SECONDS = int(os.environ.get('CUSTOMER_INDEX_RETRY_SECONDS', '60'))
+
+#Salesforce Account Ids that already have an AB customer, account id -> AB customer reference
+#next_load_at is when the index is next seeded, after the TTL or, following a failed seed, the retry delay
+_customer_index = {'references': {}, 'next_load_at': 0}
+_customer_index_lock = threading.Lock()
+
+#Seed the index from every customer this integration has already staged, AB_REFERENCE is the Salesforce Account Id
+def load_customer_index():
+    with span('snowflake', kind='System'), get_engine().connect() as conn:
+        rows = conn.execute("SELECT DISTINCT AB_REFERENCE FROM INTEGRATION_STAGING WHERE AB_REFERENCE IS NOT NULL").fetchall()
+    _customer_index['references'] = {row[0]: row[0] for row in rows}
+    _customer_index['next_load_at'] = time.time() + CUSTOMER_INDEX_TTL_SECONDS
+    logger.info(f"Customer index seeded with {len(rows)} customers")
+
+#Remember an account's AB customer so repeat deals skip the AB search
+def remember_customer(salesforce_customer_id, customer_reference):
+    with _customer_index_lock:
+        _customer_index['references'][salesforce_customer_id] = customer_reference
+
+#Resolve the AB customer reference for a Salesforce account, None when AB has no such customer
+#search=False only checks the index, for accounts already searched earlier in the invocation
+def find_customer_reference(customers_controller, salesforce_customer_id, search=True):
+    with _customer_index_lock:
+        if time.time() >= _customer_index['next_load_at']:
+            try:
+                load_customer_index()
+            except Exception as e:
+                #The AB search below still answers correctly, just slower, and later lookups skip the seed until the retry delay passes
+                logger.error(f"Error seeding customer index, retrying in {CUSTOMER_INDEX_RETRY_SECONDS}s: {e}")
+                _customer_index['next_load_at'] = time.time() + CUSTOMER_INDEX_RETRY_SECONDS
+        customer_reference = _customer_index['references'].get(salesforce_customer_id)
+    if customer_reference is not None or not search:
+        return customer_reference
+
+    #Fall back to the AB full-text search
+    collect = {
+        'page': 1,
+        'per_page': 1,
+        'q': salesforce_customer_id
+    }
+    customer_search_result = customers_controller.list_customers(collect)
+
+    #In the event the customer already exists, store the reference for use later
+    try:
+        customer_reference = [customer.customer.reference for customer in customer_search_result][0]
+    except IndexError:
+        return None
+    remember_customer(salesforce_customer_id, customer_reference)
+    return customer_reference
+
+#Decide whether an exception means our cached credentials have gone stale
+def is_auth_failure(e):
+    status_code = getattr(e, 'response_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status_code in (401, 403):
+        return True
+    message = str(e).lower()
+    return 'authentication' in message or 'jwt token is invalid' in message
+
+#Provisioned concurrency runs module init before the first request, so prime here when enabled
+if os.environ.get('PRIME_ON_INIT', 'false').lower() == 'true':
+    try:
+        prime_resources()
+    except Exception as e:
+        logger.error(f"Error priming resource cache: {e}")
+
+report_import_timings('init', time.perf_counter() - _module_init_started)
+
+#One node of the fetch stage graph, fn gets the results of its dependencies by stage name
+@dataclass
+class Stage:
+    name: str
+    fn: object
+    deps: tuple = ()
+
+#Run blocking stages on worker threads, each starting as soon as every dependency has finished
+#Stages must be listed after their dependencies, returns results and (start, end) offsets in seconds per stage
+def run_stage_graph(stages):
+    import asyncio
+
+    async def run_all():
+        started = time.perf_counter()
+        tasks = {}
+        timings = {}
+
+        async def run(stage):
+            inputs = {dep: await tasks[dep] for dep in stage.deps}
+            begin = time.perf_counter() - started
+            try:
+                return await asyncio.to_thread(stage.fn, inputs)
+            finally:
+                timings[stage.name] = (begin, time.perf_counter() - started)
+                record_metric('Stage', stage.name, timings[stage.name][1] - begin)
+
+        for stage in stages:
+            tasks[stage.name] = asyncio.ensure_future(run(stage))
+        results = await asyncio.gather(*tasks.values())
+        return dict(zip(tasks, results)), timings
+
+    return asyncio.run(run_all())
+
+#Walk back from the last stage to finish through whichever dependency finished last
+def critical_path(stages, timings):
+    deps = {stage.name: stage.deps for stage in stages}
+    name = max(timings, key=lambda n: timings[n][1])
+    path = [name]
+    while deps[name]:
+        name = max(deps[name], key=lambda n: timings[n][1])
+        path.append(name)
+    return path[::-1]
+
+#Log end-to-end latency against what the same calls would take run one after another
+def report_stage_graph(label, stages, timings):
+    report = {
+        'stage_graph': label,
+        'elapsed_ms': round(max(end for begin, end in timings.values()) * 1000, 1),
+        'sum_of_stages_ms': round(sum(end - begin for begin, end in timings.values()) * 1000, 1),
+        'critical_path': critical_path(stages, timings),
+        'stages_ms': {name: [round(begin * 1000, 1), round(end * 1000, 1)] for name, (begin, end) in timings.items()}
+    }
+    logger.info(json.dumps(report))
+
+#The opportunities with cashe products, opportunity id -> graph
+def cashe_opportunity_graphs(opportunity_graphs):
+    return {opportunity_id: graph for opportunity_id, graph in opportunity_graphs.items() if has_cashe_products(graph)}
+
+#Everything the AB stage needs from Salesforce and the warm caches, as a dependency graph
+#Only the order poll depends on the quote, so the AB client, customer lookups and price point index load run while CPQ builds the orders
+#In a batch the orders stage never raises, it returns the orders that are ready and the error (if any) that stopped the poll,
+#so one opportunity's missing order or a failed poll is reported against the cashe opportunities rather than aborting the batch
+def build_fetch_stages(opportunity_ids, query_cache, deadline_seconds, batch=False):
+    def opportunities(inputs):
+        return fetch_opportunity_graphs(opportunity_ids, query_cache, bulk=batch)
+
+    def orders(inputs):
+        expected_item_counts = {}
+        for graph in cashe_opportunity_graphs(inputs['opportunities']).values():
+            primary_quote = record_field('Opportunity', graph['opportunity'], 'SBQQ__PrimaryQuote__c')
+            #Without a primary quote CPQ never builds an order, that opportunity fails straight away instead of being polled for
+            if primary_quote is None:
+                continue
+            expected_item_counts[primary_quote] = max(expected_item_counts.get(primary_quote, 0), len(graph['line_items']))
+        if not expected_item_counts:
+            return {}, None
+        if not batch:
+            return wait_for_order_graphs(expected_item_counts, query_cache, deadline_seconds), None
+        try:
+            return wait_for_order_graphs(expected_item_counts, query_cache, deadline_seconds, partial=True), None
+        except Exception as e:
+            logger.error(f"Error polling for orders: {e}")
+            return {}, e
+
+    #The warm-up stages below are best effort, the AB stage redoes anything they could not
+    def ab_client(inputs):
+        if not cashe_opportunity_graphs(inputs['opportunities']):
+            return None
+        try:
+            import advancedbilling.models.create_subscription_request
+            return get_ab_client()
+        except Exception as e:
+            logger.error(f"Error building AB client ahead of the AB stage: {e}")
+            return None
+
+    def customers(inputs):
+        client = inputs['ab_client']
+        account_ids = {record_field('Account', graph['account'], 'Id') for graph in cashe_opportunity_graphs(inputs['opportunities']).values()}
+        searched = set()
+        if client is None:
+            return searched
+
+        def look_up(account_id):
+            try:
+                find_customer_reference(client.customers, account_id)
+                searched.add(account_id)
+            except Exception as e:
+                logger.error(f"Error looking up AB customer {account_id}: {e}")
 
-        #If the event is a string, parse it as JSON
-        if isinstance(event, str):
-            event = json.loads(event)
+        with ThreadPoolExecutor(max_workers=MAXIO_MAX_WORKERS) as executor:
+            list(executor.map(look_up, account_ids))
+        return searched
 
-        #Extract the body from the event
-        event_data = event["body"]
+    def price_point_index(inputs):
+        if not cashe_opportunity_graphs(inputs['opportunities']):
+            return None
+        try:
+            with _price_point_lock:
+                load_price_point_index()
+        except Exception as e:
+            logger.error(f"Error loading price point index: {e}")
+
+    return [
+        Stage('opportunities', opportunities),
+        Stage('orders', orders, ('opportunities',)),
+        Stage('ab_client', ab_client, ('opportunities',)),
+        Stage('customers', customers, ('opportunities', 'ab_client')),
+        Stage('price_point_index', price_point_index, ('opportunities',))
+    ]
+
+#Largest batch of opportunities one invocation accepts, the Apex caller sends at most this many ids per callout
+MAX_BATCH_OPPORTUNITIES = int(os.environ.get('MAX_BATCH_OPPORTUNITIES', '50'))
+
+#Check all of the skus on the opportunity for cashe products
+def has_cashe_products(opportunity_graph):
+    product_skus = [record_field('OpportunityLineItem', item, 'Product2.ProductCode') for item in opportunity_graph['line_items']]
+    return any(i and "CASH" in i for i in product_skus)
+
+#Create or find the AB customer, the price points and the subscription for one opportunity, returns its staging row
+#searched_accounts are accounts the fetch stage already looked up in AB, a miss there means the customer is new
+def process_opportunity(opportunity_graph, order, searched_accounts=()):
+    account = opportunity_graph['account']
+
+    #Build out the consumption tiers which will serve as the source for our component price tier
+    consumption_tiers = build_consumption_tiers(order, account)
+
+    #Get the values from the account with error handling (falling back to placeholders if not found)
+    email_value = record_field('Account', account, 'ia_crm__Email_ID__c')
+    if email_value is None:
+        email_value = record_field('SBQQ__Quote__c', opportunity_graph['quote'], 'SBQQ__PrimaryContact__r.Email')
+
+    #Create a dictionary to represent a the customer row
+    customer_row = {
+        'Reference': record_field('Account', account, 'Id'),
+        'AccName': record_field('Account', account, 'Name'),
+        'Email': email_value if email_value is not None else 'noemailprovided@testco.com',
+        'Address1': record_field('Account', account, 'BillingStreet') or '123 No St.',
+        'City': record_field('Account', account, 'BillingCity') or 'NoTown',
+        'State': record_field('Account', account, 'BillingState') or 'NS',
+        'Zip': record_field('Account', account, 'BillingPostalCode') or '55555',
+        'Country': record_field('Account', account, 'BillingCountry') or 'US',
+        'Phone': record_field('Account', account, 'Phone') or '555-555-5555'
+    }
+
+    #Only now that there is AB work to do, load the AB SDK
+    from advancedbilling.models.create_subscription_request import CreateSubscription,CreateSubscriptionRequest
+    from advancedbilling.models.create_customer_request import CreateCustomer,CreateCustomerRequest
+    from advancedbilling.models.create_subscription_component import CreateSubscriptionComponent
+    client = get_ab_client()
+
+    #Store the salesforce account id to check if AB customer record already exists
+    salesforce_customer_id = consumption_tiers[0].account_id
+
+    #Instantiatite the customer controller for the customer search, and if needed AB customer record creation
+    customers_controller = client.customers
+
+    #See if the customer already exists in AB, checking the staging index before searching AB
+    with span('ab_customer'):
+        customer_reference = find_customer_reference(customers_controller, salesforce_customer_id, search=salesforce_customer_id not in searched_accounts)
+
+    if customer_reference == None:
+        #Create the customer record in AB
+        customer_body = CreateCustomerRequest(
+        customer=CreateCustomer(
+            first_name='Accounts',
+            last_name='Payable',
+            email=customer_row['Email'],
+            organization=customer_row['AccName'],
+            reference=customer_row['Reference'],
+            address=customer_row['Address1'],
+            city=customer_row['City'],
+            state=customer_row['State'],
+            zip=customer_row['Zip'],
+            country='US',
+            phone=customer_row['Phone'],
+            locale='en-US'))
+
+        with span('ab_customer'):
+            customer_response = ab_write(
+            customers_controller.create_customer,
+            body=customer_body)
 
-        #Parse the body content
-        body = json.loads(event_data)
+        #Store the customer reference for the previously created AB customer record for use later
+        customer_reference = customer_response.customer.reference
+        remember_customer(salesforce_customer_id, customer_reference)
 
-        #Extract Opportunity_Id from the body
-        opportunity_id = body["Opportunity_Id"]
+    #From here on new and existing AB customers follow the same steps
+    #Create every product's price point concurrently
+    with span('price_points'):
+        created_price_points = create_price_points(client, consumption_tiers)
 
-        client_id = sfdc_prod_client_id
-        client_secret = sfdc_prod_secret_id
+    #Instantiate the subscriptions controller
+    subscriptions_controller = client.subscriptions
 
-        #Fetch the instance url and access token from Salesforce API
-        hostname = sfdc_hostname
-        token_url = f'{hostname}/services/oauth2/token'
+    #Create a list to hold all the subscription components
+    subscription_components = []
 
-        payload = {
-            'grant_type': 'client_credentials',
-            'client_id': client_id,
-            'client_secret': client_secret
-        }
+    #Iterate through the created_price_points dictionary to create each products subscription components
+    for product, details in created_price_points.items():
+        subscription_components.append(
+            CreateSubscriptionComponent(
+                component_id=details['component_id'],
+                enabled=True,
+                price_point_id=details['price_point_id']
+            )
+        )
 
-        response = requests.post(token_url, data=payload)
+    #Make the subscription request
+    subscription_body = CreateSubscriptionRequest(
+        subscription=CreateSubscription(
+            product_handle='monthly-usage',  #this parameter will always be the same
+            customer_reference=customer_reference,
+            components=subscription_components
+        )
+    )
 
-        token_response = response.json()
-        access_token = token_response.get('access_token')
-        instance_url = token_response.get('instance_url')
+    with span('subscription'):
+        subscription_result = ab_write(
+            subscriptions_controller.create_subscription,
+            body=subscription_body
+        )
 
-        #Build the Salesforce query url
-        query_url = f"{instance_url}/services/data/v61.0/query/"
+    #Build the snowflake staging row, load as false, we will check in the other script
+    staging_row = (customer_reference, str(int(subscription_result.subscription.id)), False)
+    return staging_row
+
+#Write-behind staging: rows are spooled durably first and merged into INTEGRATION_STAGING in batches
+#STAGING_SPOOL_DIR spools to a local directory instead of the Lambda's S3 bucket, for running offline
+STAGING_SPOOL_PREFIX = os.environ.get('STAGING_SPOOL_PREFIX', 'staging-spool/')
+STAGING_SPOOL_DIR = os.environ.get('STAGING_SPOOL_DIR')
+
+#Flush once this many rows are spooled or the oldest spooled row is this old, STAGING_FLUSH_ROWS=1 writes through
+STAGING_FLUSH_ROWS = int(os.environ.get('STAGING_FLUSH_ROWS', '25'))
+STAGING_FLUSH_MAX_AGE_SECONDS = float(os.environ.get('STAGING_FLUSH_MAX_AGE_SECONDS', '300'))
+
+#Most rows in one MERGE statement, well under Snowflake's VALUES limit
+STAGING_MERGE_CHUNK_ROWS = 1000
+
+#Spool entries are named <spooled_at_ns>-<row count>-<nonce>.json, so listing them gives their age and size without reading them
+def spool_entry_name(row_count):
+    return f"{time.time_ns()}-{row_count}-{os.urandom(4).hex()}.json"
+
+def parse_spool_entry_name(name):
+    spooled_at_ns, row_count, _ = os.path.basename(name).split('-', 2)
+    return int(spooled_at_ns) / 1e9, int(row_count)
+
+#Hand staging rows off to the spool, once this returns the rows survive the container being recycled
+def spool_staging_rows(staging_rows):
+    name = spool_entry_name(len(staging_rows))
+    body = json.dumps({'rows': [list(row) for row in staging_rows]})
+    if STAGING_SPOOL_DIR:
+        os.makedirs(STAGING_SPOOL_DIR, exist_ok=True)
+        path = os.path.join(STAGING_SPOOL_DIR, name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+        return
+    import boto3
+
+    with span('s3', kind='System') as current:
+        boto3.client('s3').put_object(Bucket=s3_bucket, Key=STAGING_SPOOL_PREFIX + name, Body=body.encode())
+        current['bytes'] = len(body)
+
+#Every spooled entry, oldest first
+def list_spooled_staging():
+    if STAGING_SPOOL_DIR:
+        if not os.path.isdir(STAGING_SPOOL_DIR):
+            return []
+        return sorted(os.path.join(STAGING_SPOOL_DIR, name) for name in os.listdir(STAGING_SPOOL_DIR) if name.endswith('.json'))
+    import boto3
+
+    keys = []
+    with span('s3', kind='System'):
+        for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=STAGING_SPOOL_PREFIX):
+            keys.extend(item['Key'] for item in page.get('Contents', []) if item['Key'].endswith('.json'))
+    return sorted(keys)
+
+#Read a spooled entry's rows, None when a concurrent flush already merged and deleted it
+def read_spooled_staging(entry):
+    if STAGING_SPOOL_DIR:
+        try:
+            with open(entry) as f:
+                return [tuple(row) for row in json.load(f)['rows']]
+        except FileNotFoundError:
+            return None
+    import boto3
 
-        #Headers for each Salesforce query
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
+    s3_client = boto3.client('s3')
+    try:
+        with span('s3', kind='System') as current:
+            body = s3_client.get_object(Bucket=s3_bucket, Key=entry)['Body'].read()
+            current['bytes'] = len(body)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return [tuple(row) for row in json.loads(body)['rows']]
+
+def delete_spooled_staging(entries):
+    if STAGING_SPOOL_DIR:
+        for entry in entries:
+            if os.path.exists(entry):
+                os.remove(entry)
+        return
+    import boto3
+
+    s3_client = boto3.client('s3')
+    for i in range(0, len(entries), 1000):
+        with span('s3', kind='System'):
+            s3_client.delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': key} for key in entries[i:i + 1000]], 'Quiet': True})
+
+#Merge staging rows into INTEGRATION_STAGING keyed on the subscription, so replaying a spool entry never duplicates a row
+def merge_staging_rows(staging_rows):
+    with span('snowflake', kind='System') as current, get_engine().connect() as conn:
+        for i in range(0, len(staging_rows), STAGING_MERGE_CHUNK_ROWS):
+            chunk = staging_rows[i:i + STAGING_MERGE_CHUNK_ROWS]
+            values = ', '.join(['(%s, %s, %s)'] * len(chunk))
+            merge_query = f"""
+                MERGE INTO INTEGRATION_STAGING t
+                USING (SELECT column1 AS AB_REFERENCE, column2 AS AB_SUBSCRIPTION, column3 AS AB_CONTRACT_ASSOC_COMPLETE FROM VALUES {values}) s
+                ON t.AB_SUBSCRIPTION = s.AB_SUBSCRIPTION
+                WHEN NOT MATCHED THEN INSERT (AB_REFERENCE, AB_SUBSCRIPTION, AB_CONTRACT_ASSOC_COMPLETE, INSERTED_AT, ASSOC_ATTEMPTS)
+                VALUES (s.AB_REFERENCE, s.AB_SUBSCRIPTION, s.AB_CONTRACT_ASSOC_COMPLETE, CURRENT_TIMESTAMP()::TIMESTAMP_NTZ, 0)
+            """
+            params = tuple(value for row in chunk for value in row)
+            current['bytes'] += len(merge_query) + sum(len(str(value)) for value in params)
+            conn.execute(merge_query, [params])
+
+#Merge everything spooled into Snowflake once enough rows are waiting or the oldest has waited long enough
+#Entries are only deleted after their rows are merged, a flush that dies half way is simply replayed by the next one
+def flush_staging_rows(force=False):
+    entries = list_spooled_staging()
+    if not entries:
+        return None
+    spooled = [parse_spool_entry_name(entry) for entry in entries]
+    pending_rows = sum(row_count for spooled_at, row_count in spooled)
+    oldest_age = time.time() - min(spooled_at for spooled_at, row_count in spooled)
+    if not force and pending_rows < STAGING_FLUSH_ROWS and oldest_age < STAGING_FLUSH_MAX_AGE_SECONDS:
+        return None
+
+    started = time.perf_counter()
+    staging_rows = []
+    merged_entries = []
+    for entry in entries:
+        rows = read_spooled_staging(entry)
+        if rows is not None:
+            staging_rows.extend(rows)
+            merged_entries.append(entry)
+    if staging_rows:
+        merge_staging_rows(staging_rows)
+    delete_spooled_staging(merged_entries)
+    report = {
+        'staging_flush': len(staging_rows),
+        'spool_entries': len(merged_entries),
+        'oldest_age_seconds': round(oldest_age, 1),
+        'flush_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    logger.info(json.dumps(report))
+    return report
+
+#Stage rows for the Glue job, once this returns they survive the container being recycled
+#If the spool itself is unavailable the rows are merged straight away, so they are never only in memory
+def stage_rows(staging_rows):
+    if not staging_rows:
+        return
+    try:
+        spool_staging_rows(staging_rows)
+    except Exception as e:
+        logger.error(f"Error spooling staging rows, merging them directly: {e}")
+        merge_staging_rows(staging_rows)
 
-        #Validate the bu
-        opp_query = f"""
-        SELECT fields(all)
-        from opportunity
-        where Id = '{opportunity_id}'
-        limit 200
-        """
-        opp_params = {'q': opp_query}
-        opp_response = requests.get(query_url, headers=headers, params=opp_params)
-        opp_records = opp_response.json()['records']
-        primary_quote = opp_response.json()['records'][0].get('SBQQ__PrimaryQuote__c')
-        primary_contact = opp_response.json()['records'][0].get('ContactId')
-        opp_df = pd.DataFrame(opp_records)
-
-        opp_line_item_query = f"""
-        SELECT fields(all)
-        FROM OpportunityLineItem
-        WHERE OpportunityId = '{opportunity_id}'
-        LIMIT 200
-        """
-        opp_li_params = {'q': opp_line_item_query}
-        opp_li_response = requests.get(query_url, headers=headers, params=opp_li_params)
-
-        #Process the response to extract the records
-        opp_li_records = opp_li_response.json().get('records', [])
-        product_ids = [record.get('Product2Id') for record in opp_li_records]
-        product_ids_string = ','.join(f"'{id}'" for id in product_ids)
-
-        product_name_query = f"""
-        SELECT fields(ALL)
-        from Product2
-        where Id in ({product_ids_string})
-        limit 200
-        """
-        product_params = {'q': product_name_query}
-        product_response = requests.get(query_url, headers=headers, params=product_params)
-        products = product_response.json().get('records', [])
-        product_skus = [i.get('ProductCode') for i in products]
-
-        #Check all of the skus on the opportunity, if cashe continue, if not exit
-        if any("CASH" in i for i in product_skus):
-            pass
+#Flush the spool if it is due, staged rows are already safe so a failed flush is retried by the next invocation or flush event
+def flush_staged_rows():
+    try:
+        flush_staging_rows()
+    except Exception as e:
+        logger.error(f"Error flushing staging spool: {e}")
+        if is_auth_failure(e):
+            invalidate_resources()
+
+#Run a batch of opportunities with shared auth, caches and bulk queries, returns opportunity id -> result
+#With raise_errors the first failure propagates, otherwise each opportunity reports its own status
+def process_opportunities(opportunity_ids, query_cache, deadline_seconds, raise_errors=False):
+    results = {}
+
+    def fail(opportunity_id, e):
+        logger.error(f"Error processing opportunity {opportunity_id}: {e}")
+        #Drop cached credentials on auth failures so the next opportunity or invocation rebuilds them
+        if is_auth_failure(e):
+            invalidate_resources()
+        if raise_errors:
+            raise e
+        results[opportunity_id] = {'status': 'failed', 'error': str(e)}
+
+    #Fetch the opportunities, then wait for CPQ to build their orders while the AB client, customer lookups and price point index warm up
+    stages = build_fetch_stages(opportunity_ids, query_cache, deadline_seconds, batch=not raise_errors)
+    try:
+        with span('fetch'):
+            fetched, timings = run_stage_graph(stages)
+    except Exception as e:
+        #In a batch only the opportunities fetch itself can get here, without it nothing is known about any of them
+        if raise_errors:
+            raise
+        for opportunity_id in opportunity_ids:
+            fail(opportunity_id, e)
+        return results
+    report_stage_graph('fetch', stages, timings)
+    opportunity_graphs = fetched['opportunities']
+    orders, order_error = fetched['orders']
+
+    cashe_graphs = {}
+    for opportunity_id in opportunity_ids:
+        opportunity_graph = opportunity_graphs.get(opportunity_id)
+        if opportunity_graph is None:
+            fail(opportunity_id, LookupError(f"Opportunity {opportunity_id} not found"))
+        elif not has_cashe_products(opportunity_graph):
+            results[opportunity_id] = {'status': 'skipped', 'message': 'Found no cashe products on opportunity'}
+        elif record_field('Opportunity', opportunity_graph['opportunity'], 'SBQQ__PrimaryQuote__c') is None:
+            fail(opportunity_id, LookupError(f"Opportunity {opportunity_id} has cashe products but no primary quote"))
         else:
-            return {"statusCode": 200, "body": json.dumps({"message": "Found no cashe products on opportunity, exiting function."})}
-
-        #Query the opportunity table to fetch the primary quote
-        opp_query = f"""
-            SELECT fields(all)
-            from opportunity
-            where Id = '{opportunity_id}'
-            limit 200
-        """
-
-        opp_params = {'q': opp_query}
-        opp_response = requests.get(query_url, headers=headers, params=opp_params)
-        opp_records = opp_response.json()['records']
-        primary_quote = opp_response.json()['records'][0].get('SBQQ__PrimaryQuote__c')
-        primary_contact = opp_response.json()['records'][0].get('ContactId')
-        opp_df = pd.DataFrame(opp_records)
-
-        #Query the quote table to fetch the primary contact
-        quote_query = f"""
-        SELECT fields(ALL)
-        from SBQQ__Quote__c
-        where Id = '{primary_quote}'
-        limit 200
-        """
-
-        quote_params = {'q': quote_query}
-        quote_response = requests.get(query_url, headers=headers, params=quote_params)
-        primary_contact = quote_response.json()['records'][0].get('SBQQ__PrimaryContact__c')
-
-        #Query the contact table
-        contact_name_query = f"""
-            SELECT fields(ALL)
-            from Contact
-            where Id = '{primary_contact}'
-            limit 200
-        """
-
-        contact_params = {'q': contact_name_query}
-        contact_response = requests.get(query_url, headers=headers, params=contact_params)
-
-        time.sleep(30)
-
-        #Query the order table
-        order_query = f"""
-            SELECT fields(all)
-            from order
-            where SBQQ__Quote__c = '{primary_quote}'
-            limit 200
-        """
-
-        order_params = {'q': order_query}
-        order_response = requests.get(query_url, headers=headers, params=order_params)
-        order_id = order_response.json()['records'][0].get('Id')
-
-        #Query the order item table
-        orderitem_query = f"""
-            SELECT fields(ALL)
-            from OrderItem
-            where orderid = '{order_id}'
-            limit 200
-        """
-
-        orderitem_params = {'q': orderitem_query}
-        orderitem_response = requests.get(query_url, headers=headers, params=orderitem_params)
-        item_records = orderitem_response.json().get('records', [])
-        order_item_ids = ','.join([f"'{record.get('Id')}'" for record in item_records if record.get('Id')])
-        order_item_df = pd.DataFrame(item_records)
-
-            #Query the consumption table
-        consumption_schedule_query = f"""
-            SELECT fields(ALL)
-            from SBQQ__OrderItemConsumptionSchedule__c
-            where SBQQ__OrderItem__c in ({order_item_ids})
-            limit 200
-        """
-
-        conssched_params = {'q': consumption_schedule_query}
-        conssched_response = requests.get(query_url, headers=headers, params=conssched_params)
-        cons_records = conssched_response.json().get('records', [])
-        cons_schedule_ids = ','.join([f"'{record.get('Id')}'" for record in cons_records if record.get('Id')])
-        cons_item_df = pd.DataFrame(cons_records)
-
-        #Query the consumption rate table
-        consumption_rate_query = f"""
-            SELECT fields(all)
-            from SBQQ__OrderItemConsumptionRate__c
-            where SBQQ__OrderItemConsumptionSchedule__c in ({cons_schedule_ids})
-            limit 200
-        """
-        consrate_params = {'q': consumption_rate_query}
-        consrate_response = requests.get(query_url, headers=headers, params=consrate_params)
-        cons_rates = consrate_response.json().get('records', [])
-        cons_rate_df = pd.DataFrame(cons_rates)
-
-        #Do some data transformation for final price consumption dataframe
-        item_cols_to_keep = ['Id','Product2Id']
-        temp_orderitem_df = order_item_df[item_cols_to_keep]
-        fin_orderitem_df = temp_orderitem_df.rename(columns={'Id':'OrderLineId','Product2Id':'ProductID'})
-
-        cons_cols_to_keep = ['Id','SBQQ__OrderItem__c']
-        temp_cons_item_df = cons_item_df[cons_cols_to_keep]
-        fin_cons_item_df = temp_cons_item_df.rename(columns={'Id':'ConsScheduleId','SBQQ__OrderItem__c':'OrderLineId'})
-
-        cons_rate_cols_to_keep = ['SBQQ__OrderItemConsumptionSchedule__c','Name','SBQQ__LowerBound__c','SBQQ__Price__c']
-        temp_cons_rate_item_df = cons_rate_df[cons_rate_cols_to_keep]
-        fin_cons_rate_item_df = temp_cons_rate_item_df.rename(columns={'SBQQ__OrderItemConsumptionSchedule__c':'ConsScheduleId','SBQQ__LowerBound__c':'LowerBound','SBQQ__Price__c':'PricePer'})
-
-        first_merged_df = pd.merge(fin_orderitem_df,fin_cons_item_df,left_on='OrderLineId',right_on='OrderLineId',how='left')
-        second_merged_df = pd.merge(first_merged_df,fin_cons_rate_item_df,left_on='ConsScheduleId',right_on='ConsScheduleId',how='left')
-
-        second_merged_df['AccountID'] = opp_df['AccountId'].iloc[0]
-
-        account_name_query = f"""
-            SELECT fields(ALL)
-            from Account
-            where Id = '{second_merged_df['AccountID'][0]}'
-            limit 200
-        """
-
-        accname_params = {'q': account_name_query}
-        accname_response = requests.get(query_url, headers=headers, params=accname_params)
-        accname = accname_response.json()['records'][0].get('Name')
-
-        second_merged_df['AccountName'] = accname
-
-        product_ids_string = ','.join(f"'{id}'" for id in second_merged_df['ProductID'])
-
-        product_name_query = f"""
-            SELECT fields(ALL)
-            from Product2
-            where Id in ({product_ids_string})
-            limit 200
-        """
-
-        product_params = {'q': product_name_query}
-        product_response = requests.get(query_url, headers=headers, params=product_params)
-        products = product_response.json().get('records', [])
-        product_name_df = pd.DataFrame(products)
-        product_cols_to_keep = ['Id','Name']
-        temp_product_df = product_name_df[product_cols_to_keep]
-        final_product_df = temp_product_df.rename(columns={'Id':'ProductID','Name':'ProductName'})
-
-        #Build out the dataframe which will serve as the source for our component price tier
-        final_salesforce_df = pd.merge(second_merged_df,final_product_df,left_on='ProductID',right_on='ProductID',how='left')
-
-        #Remove products that do not have a consumption schedule
-        final_salesforce_df.dropna(inplace=True)
-
-        #Initialize an empty DataFrame with multiple columns
-        customer_create_df = pd.DataFrame(columns=['Reference','AccName','Email','Address1','City','State','Zip','Country','Phone'])
-
-        #Get the values from the response with error handling (assigning None if not found)
-        id_value = accname_response.json()['records'][0].get('Id', None)
-        name_value = accname_response.json()['records'][0].get('Name', None)
-        email_value = accname_response.json()['records'][0].get('ia_crm__Email_ID__c', None)
-        if email_value is None:
-            email_value = contact_response.json()[0].get('Email', 'noemailprovided@testco.com') if isinstance(contact_response.json(), list) else contact_response.json().get('records', [{}])[0].get('Email', 'noemailprovided@testco.com')
-        address_value = accname_response.json()['records'][0].get('BillingStreet', None)
-        city_value = accname_response.json()['records'][0].get('BillingCity', None)
-        state_value = accname_response.json()['records'][0].get('BillingState', None)
-        zip_value = accname_response.json()['records'][0].get('BillingPostalCode', None)
-        country_value = accname_response.json()['records'][0].get('BillingCountry', None)
-        phone_value = accname_response.json()['records'][0].get('Phone', None)
-
-        #Create a dictionary to represent a the customer row
-        create_customer_row = {
-            'Reference': id_value if id_value is not None else np.nan,
-            'AccName': name_value if name_value is not None else np.nan,
-            'Email': email_value if email_value is not None else 'noemailprovided@testco.com',
-            'Address1': address_value if address_value is not None else '123 No St.',
-            'City': city_value if city_value is not None else 'NoTown',
-            'State': state_value if state_value is not None else 'NS',
-            'Zip': zip_value if zip_value is not None else '55555',
-            'Country': country_value if country_value is not None else 'US',
-            'Phone': phone_value if phone_value is not None else '555-555-5555'
-        }
-
-        #Convert the dictionary to a dataframe
-        create_customer_row_df = pd.DataFrame([create_customer_row])
+            cashe_graphs[opportunity_id] = opportunity_graph
 
-        #Concat the create customer row dataFrame to the create customer dataFrame
-        customer_create_df = pd.concat([customer_create_df, create_customer_row_df], ignore_index=True)
+    if not cashe_graphs:
+        return results
+    logger.info(f"SOQL cache: {query_cache.stats()}")
+    logger.info(f"HTTP connection reuse: {http_session_stats()}")
 
-        #Store the salesforce account id to check if AB customer record already exists
-        salesforce_customer_id = final_salesforce_df['AccountID'].iloc[0]
-
-        #Instantiatite the AB client
-        client = AdvancedBillingClient(
-            basic_auth_credentials=BasicAuthCredentials(
-                username=maxio_prod_api_key,
-                password='x'
-            ),
-            subdomain=maxio_ab_domain,
-            domain='chargify.com'
-        )
-
-        #Instantiatite the customer controller for the customer search, and if needed AB customer record creation
-        customers_controller = client.customers
-
-        #See if the customer already exists in AB
-        collect = {
-            'page': 1,
-            'per_page': 1,
-            'q': salesforce_customer_id
-        }
-        customer_search_result = customers_controller.list_customers(collect)
-
-        #In the event the customer already exists, store the reference for use later
+    for opportunity_id, opportunity_graph in cashe_graphs.items():
+        order = orders.get(record_field('Opportunity', opportunity_graph['opportunity'], 'SBQQ__PrimaryQuote__c'))
         try:
-            customer_reference = [customer.customer.reference for customer in customer_search_result][0]
-        except IndexError:
-            customer_reference = None
+            if order is None:
+                raise order_error or TimeoutError(f"Order for opportunity {opportunity_id} not ready after {deadline_seconds:.0f}s")
+            staging_row = process_opportunity(opportunity_graph, order, fetched['customers'])
+        except Exception as e:
+            fail(opportunity_id, e)
+            continue
+
+        #Stage the subscription as soon as it exists in AB, so a timeout or recycled container later in the batch cannot lose its row
         try:
-            customer_ab_id = [customer.customer.id for customer in customer_search_result][0]
-        except IndexError:
-            customer_ab_id = None
-
-        if customer_reference == None:
-            #Create the customer record in AB
-            customer_body = CreateCustomerRequest(
-            customer=CreateCustomer(
-                first_name='Accounts',
-                last_name='Payable',
-                email=customer_create_df['Email'].iloc[0],
-                organization=customer_create_df['AccName'].iloc[0],
-                reference=customer_create_df['Reference'].iloc[0],
-                address=customer_create_df['Address1'].iloc[0],
-                city=customer_create_df['City'].iloc[0],
-                state=customer_create_df['State'].iloc[0],
-                zip=customer_create_df['Zip'].iloc[0],
-                country='US',
-                phone=customer_create_df['Phone'].iloc[0],
-                locale='en-US'))
-
-            customer_response = customers_controller.create_customer(
-            body=customer_body)
+            with span('staging'):
+                stage_rows([staging_row])
+        except Exception as e:
+            fail(opportunity_id, RuntimeError(f"Subscription {staging_row[1]} created but not staged: {e}"))
+            continue
+        results[opportunity_id] = {'status': 'processed', 'customer_reference': staging_row[0], 'subscription_id': staging_row[1]}
 
-            #Store the customer reference for the previously created AB customer record for use later
-            customer_reference = customer_response.customer.reference
-
-            unique_products = final_salesforce_df['ProductName'].unique()
-
-            product_specific_dataframes = {}
-
-            #Split the dataframe into unique dataframes per product
-            for product in unique_products:
-                product_specific_dataframes[product] = final_salesforce_df[final_salesforce_df['ProductName'] == product]
-
-            component_dictionary = {'Pavillio Subscription - Core Billing':'2544422','Pavillio Subscription - County Billing':'2544424',
-                                    'Managed Billing Subscription':'2554766','Pavillio Per Client Fee':'2544421','Pavillio Platform - Basic':'2544427',
-                                    'Pavillio Platform - Lite':'2544427','Billing Services Subscription (By Claim)': '2544425'}
-
-            #Instantiate the component price points controller
-            component_price_points_controller = client.component_price_points
-
-            #Create a dictionary to store created price points
-            created_price_points = {}
-
-            for product, df in product_specific_dataframes.items():
-                component_id = component_dictionary.get(product)
-                
-                if component_id is None:
-                    continue
-                
-                prices_list = []
-                
-                #Build the consumption price point from the specific product salesforce consumption schedules
-                for i in range(len(df) - 1):
-                    starting_quantity = df['LowerBound'].iloc[i]
-                    ending_quantity = df['LowerBound'].iloc[i + 1] - 1
-                    unit_price = df['PricePer'].iloc[i]
-                    
-                    #Build the dynamic Maxio AB price object
-                    prices_list.append(Price(
-                        starting_quantity=str(starting_quantity),
-                        ending_quantity=str(ending_quantity),
-                        unit_price=str(unit_price)
-                    ))
-
-                #Handle the last row (no ending quantity limit for the last tier
-                prices_list.append(Price(
-                    starting_quantity=str(df['LowerBound'].iloc[-1]),
-                    ending_quantity=None,
-                    unit_price=str(df['PricePer'].iloc[-1])
-                ))
-
-                #Assign a unique name to the component price point
-                price_point_name = f"{df['AccountName'].iloc[0]}_{random.randint(45205,985478)}"
-
-                price_point_body = CreateComponentPricePointRequest(
-                    price_point=CreateComponentPricePoint(
-                        name=price_point_name,
-                        pricing_scheme=PricingScheme.VOLUME,
-                        prices=prices_list,
-                        use_site_exchange_rate=False
-                    )
-                )
-
-                try:
-                    price_point_response = component_price_points_controller.create_component_price_point(
-                        component_id,
-                        body=price_point_body
-                    )
-
-                    #Store the created price point in the dictionary for use later
-                    created_price_points[product] = {
-                        'component_id': component_id,
-                        'price_point_id': price_point_response.price_point.id,
-                        'price_point_name': price_point_name
-                    }
-                except Exception as e:
-                    print(f"Failed to create price point for {product}: {str(e)}")
-
-            #Instantiate the subscriptions controller
-            subscriptions_controller = client.subscriptions
-
-            #Create a list to hold all the subscription components
-            subscription_components = []
-
-            #Iterate through the created_price_points dictionary to create each products subscription components
-            for product, details in created_price_points.items():
-                subscription_components.append(
-                    CreateSubscriptionComponent(
-                        component_id=details['component_id'],
-                        enabled=True,
-                        price_point_id=details['price_point_id']
-                    )
-                )
-
-            #Make the subscription request
-            subscription_body = CreateSubscriptionRequest(
-                subscription=CreateSubscription(
-                    product_handle='monthly-usage',  #this parameter will always be the same
-                    customer_reference=customer_reference,
-                    components=subscription_components
-                )
-            )
-
-            subscription_result = subscriptions_controller.create_subscription(
-                body=subscription_body
-            )
-
-            #Build snowflake import dataframe
-            snowflake_df = pd.DataFrame()
-            snowflake_df['AB_REFERENCE'] = []
-            snowflake_df['AB_SUBSCRIPTION'] = []
-            snowflake_df['AB_CONTRACT_ASSOC_COMPLETE'] = []
-
-            snowflake_df.loc[0, 'AB_REFERENCE'] = customer_response.customer.reference
-            snowflake_df.loc[0, 'AB_SUBSCRIPTION'] = subscription_result.subscription.id
-            snowflake_df['AB_SUBSCRIPTION'] = snowflake_df['AB_SUBSCRIPTION'].astype(int).astype(str)
-            snowflake_df['AB_CONTRACT_ASSOC_COMPLETE'] = 'FALSE'
-
-            #Instantiate SQLAlchemy engine with the private key
-            engine = create_engine(
-                connection_string,
-                connect_args={
-                    "private_key": private_key_bytes
-                }
-            )
-
-            table_name = 'INTEGRATION_STAGING' 
+    #Merge the spool once for the whole batch if it is due
+    with span('staging_flush'):
+        flush_staged_rows()
 
-            with engine.connect() as conn:
-                table_name = 'INTEGRATION_STAGING'
+    return results
 
-                #Ensure column names are consistent
-                snowflake_df.columns = [col.upper() for col in snowflake_df.columns]
-
-                #Construct the insert statement
-                columns = ', '.join(snowflake_df.columns)
-                placeholders = ', '.join(['%s'] * len(snowflake_df.columns))
-
-                #Convert chunk data to list of tuples
-                data_tuples = [tuple(row) for row in snowflake_df.itertuples(index=False, name=None)]
-
-                insert_query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
-
-                conn.execute(insert_query,data_tuples)
+def lambda_handler(event, context):
+    print("Recieved event:", json.dumps(event,indent=2))
+    logger.info("Lambda function started")
 
-        #If the AB customer already exists, follow many of the steps above, with the exception of the AB customer creation
-        else:
-            unique_products = final_salesforce_df['ProductName'].unique()
-
-            product_specific_dataframes = {}
-
-            #Split the dataframe into unique dataframes per product
-            for product in unique_products:
-                product_specific_dataframes[product] = final_salesforce_df[final_salesforce_df['ProductName'] == product]
-
-            component_dictionary = {'Pavillio Subscription - Core Billing':'2544422','Pavillio Subscription - County Billing':'2544424',
-                                    'Managed Billing Subscription':'2554766','Pavillio Per Client Fee':'2544421','Pavillio Platform - Basic':'2544427',
-                                    'Pavillio Platform - Lite':'2544427','Billing Services Subscription (By Claim)': '2544425'}
-
-            #Instantiate the component price points controller
-            component_price_points_controller = client.component_price_points
-
-            #Create a dictionary to store created price points
-            created_price_points = {}
-
-            for product, df in product_specific_dataframes.items():
-                component_id = component_dictionary.get(product)
-                
-                if component_id is None:
-                    continue
-                
-                prices_list = []
-                
-                #Build the consumption price point from the specific product salesforce consumption schedules
-                for i in range(len(df) - 1):
-                    starting_quantity = df['LowerBound'].iloc[i]
-                    ending_quantity = df['LowerBound'].iloc[i + 1] - 1
-                    unit_price = df['PricePer'].iloc[i]
-                    
-                    #Build the dynamic Maxio AB price object
-                    prices_list.append(Price(
-                        starting_quantity=str(starting_quantity),
-                        ending_quantity=str(ending_quantity),
-                        unit_price=str(unit_price)
-                    ))
-
-                #Handle the last row (no ending quantity limit for the last tier
-                prices_list.append(Price(
-                    starting_quantity=str(df['LowerBound'].iloc[-1]),
-                    ending_quantity=None,
-                    unit_price=str(df['PricePer'].iloc[-1])
-                ))
-
-                #Assign a unique name to the component price point
-                price_point_name = f"{df['AccountName'].iloc[0]}_{random.randint(45205,985478)}"
-
-                price_point_body = CreateComponentPricePointRequest(
-                    price_point=CreateComponentPricePoint(
-                        name=price_point_name,
-                        pricing_scheme=PricingScheme.VOLUME,
-                        prices=prices_list,
-                        use_site_exchange_rate=False
-                    )
-                )
-
-                try:
-                    price_point_response = component_price_points_controller.create_component_price_point(
-                        component_id,
-                        body=price_point_body
-                    )
-
-                    #Store the created price point in the dictionary for use later
-                    created_price_points[product] = {
-                        'component_id': component_id,
-                        'price_point_id': price_point_response.price_point.id,
-                        'price_point_name': price_point_name
-                    }
-                except Exception as e:
-                    print(f"Failed to create price point for {product}: {str(e)}")
-
-            #Instantiate the subscriptions controller
-            subscriptions_controller = client.subscriptions
-
-            #Create a list to hold all the subscription components
-            subscription_components = []
-
-            #Iterate through the created_price_points dictionary to create each products subscription components
-            for product, details in created_price_points.items():
-                subscription_components.append(
-                    CreateSubscriptionComponent(
-                        component_id=details['component_id'],
-                        enabled=True,
-                        price_point_id=details['price_point_id']
-                    )
-                )
-
-            #Make the subscription request
-            subscription_body = CreateSubscriptionRequest(
-                subscription=CreateSubscription(
-                    product_handle='monthly-usage',  #this parameter will always be the same
-                    customer_reference=customer_reference,
-                    components=subscription_components
-                )
-            )
+    #Warmer / provisioned concurrency ping, only build the resource cache
+    if isinstance(event, dict) and event.get('prime'):
+        with span('prime'):
+            prime_resources()
+        flush_metrics()
+        return {"statusCode": 200, "body": json.dumps({"message": "Primed"})}
 
-            subscription_result = subscriptions_controller.create_subscription(
-                body=subscription_body
-            )
+    #Scheduled flush, merges whatever is still spooled however few rows there are
+    if isinstance(event, dict) and event.get('flush_staging'):
+        with span('staging_flush'):
+            report = flush_staging_rows(force=True)
+        flush_metrics()
+        return {"statusCode": 200, "body": json.dumps({"message": "Flushed", "flush": report})}
 
-            #Build snowflake import dataframe
-            snowflake_df = pd.DataFrame()
-            snowflake_df['AB_REFERENCE'] = []
-            snowflake_df['AB_SUBSCRIPTION'] = []
-            snowflake_df['AB_CONTRACT_ASSOC_COMPLETE'] = []
-
-            snowflake_df.loc[0, 'AB_REFERENCE'] = customer_reference
-            snowflake_df.loc[0, 'AB_SUBSCRIPTION'] = subscription_result.subscription.id
-            snowflake_df['AB_SUBSCRIPTION'] = snowflake_df['AB_SUBSCRIPTION'].astype(int).astype(str)
-            #Load as false, we will check in the other script
-            snowflake_df['AB_CONTRACT_ASSOC_COMPLETE'] = 'FALSE'
-
-            #Instantiate SQLAlchemy engine with the private key
-            engine = create_engine(
-                connection_string,
-                connect_args={
-                    "private_key": private_key_bytes
-                }
-            )
+    try:
+        #If the event is a string, parse it as JSON
+        if isinstance(event, str):
+            event = json.loads(event)
 
-            with engine.connect() as conn:
-                table_name = 'INTEGRATION_STAGING'
+        #Extract the body from the event
+        event_data = event["body"]
 
-                #Ensure column names are consistent
-                snowflake_df.columns = [col.upper() for col in snowflake_df.columns]
+        #Parse the body content
+        body = json.loads(event_data)
 
-                #Construct the insert statement
-                columns = ', '.join(snowflake_df.columns)
-                placeholders = ', '.join(['%s'] * len(snowflake_df.columns))
+        #A batch sends Opportunity_Ids, a single opportunity Opportunity_Id
+        batch = 'Opportunity_Ids' in body
+        opportunity_ids = list(dict.fromkeys(body["Opportunity_Ids"])) if batch else [body["Opportunity_Id"]]
+        if len(opportunity_ids) > MAX_BATCH_OPPORTUNITIES:
+            return {"statusCode": 400, "body": json.dumps({"message": f"At most {MAX_BATCH_OPPORTUNITIES} opportunities per request"})}
 
-                #Convert chunk data to list of tuples
-                data_tuples = [tuple(row) for row in snowflake_df.itertuples(index=False, name=None)]
+        #Pull secrets, key material, engine and AB client from the warm-container cache
+        with span('resources'):
+            get_resources()
 
-                insert_query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+        #Request-scoped memo for every Salesforce read in this invocation
+        query_cache = QueryCache()
 
-                conn.execute(insert_query,data_tuples)
+        #Wait for CPQ to build the orders, never past the point where the Lambda would time out
+        #Short function timeouts still get a real wait, half the remaining time, rather than a single poll
+        deadline_seconds = ORDER_POLL_DEADLINE_SECONDS
+        if context is not None:
+            remaining_seconds = context.get_remaining_time_in_millis() / 1000
+            deadline_seconds = min(deadline_seconds, max(remaining_seconds - ORDER_POLL_RESERVE_SECONDS, remaining_seconds / 2))
 
+        #A single opportunity keeps failing the whole invocation, a batch reports per opportunity
+        results = process_opportunities(opportunity_ids, query_cache, deadline_seconds, raise_errors=not batch)
 
     except Exception as e:
         logger.error(f"Error in lambda_handler: {e}")
+        #Drop cached credentials on auth failures so the next invocation rebuilds them
+        if is_auth_failure(e):
+            invalidate_resources()
         raise
+    finally:
+        report_import_timings('lambda_handler')
+        flush_metrics({'RequestId': context.aws_request_id} if context is not None else None)
+
+    if batch:
+        counts = {status: sum(1 for r in results.values() if r['status'] == status) for status in ('processed', 'skipped', 'failed')}
+        logger.info(f"Batch of {len(opportunity_ids)} opportunities: {counts}")
+        return {"statusCode": 200, "body": json.dumps({"message": "Batch complete", "counts": counts, "results": results})}
 
+    if results[opportunity_ids[0]]['status'] == 'skipped':
+        return {"statusCode": 200, "body": json.dumps({"message": "Found no cashe products on opportunity, exiting function."})}
     return {"statusCode": 200, "body": json.dumps({"message": "Success"})}
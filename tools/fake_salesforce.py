@@ -0,0 +1,186 @@
+#Local fake Salesforce REST API for exercising the Lambda's fetch stage offline
+#
+#Serves the OAuth token, SOQL query and composite endpoints from a json fixture file shaped like
+#{"Opportunity": [records...], "Account": [...], "Order": [...]}. Records may carry nested
+#relationship results exactly as Salesforce returns them. Only simple WHERE clauses are
+#understood (Field = 'value' and Field IN ('a','b') joined with AND), which is all the handler uses.
+#
+#   python tools/fake_salesforce.py fixtures.json --port 8765 --latency-ms 80 --page-size 2000
+#
+#Point the sfdc_hostname secret at http://localhost:8765 (see SECRETS_SOURCE in the README).
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote_plus, urlparse
+
+#Strip nested subqueries so only the outer FROM/WHERE clauses are left
+def strip_subqueries(soql):
+    pattern = re.compile(r'\(\s*select[^()]*\)', re.IGNORECASE)
+    while pattern.search(soql):
+        soql = pattern.sub('', soql)
+    return soql
+
+#Run a SOQL query against the fixtures
+def run_query(fixtures, soql):
+    outer = strip_subqueries(soql)
+    sobject = re.search(r'\bfrom\s+(\w+)', outer, re.IGNORECASE).group(1)
+    records = next((value for key, value in fixtures.items() if key.lower() == sobject.lower()), [])
+
+    where = re.search(r'\bwhere\b(.*?)(\blimit\b|\border\s+by\b|$)', outer, re.IGNORECASE | re.DOTALL)
+    conditions = []
+    if where:
+        for field, value in re.findall(r"(\w+)\s*=\s*'([^']*)'", where.group(1)):
+            conditions.append((field, {value}))
+        for field, values in re.findall(r'(\w+)\s+in\s*\(([^)]*)\)', where.group(1), re.IGNORECASE):
+            conditions.append((field, set(re.findall(r"'([^']*)'", values))))
+
+    def matches(record):
+        lowered = {key.lower(): value for key, value in record.items()}
+        return all(lowered.get(field.lower()) in values for field, values in conditions)
+
+    matched = [record for record in records if matches(record)]
+    return {'totalSize': len(matched), 'done': True, 'records': matched}
+
+#Resolve a composite reference such as opp.records[0].AccountId against earlier results
+#Like Salesforce, a null or missing value (or a reference to a failed subrequest) is an error rather than the string null
+def resolve_reference(results, path):
+    parts = re.findall(r'[^.\[\]]+', path)
+    value = results.get(parts[0])
+    for part in parts[1:]:
+        if isinstance(value, list):
+            value = value[int(part)] if int(part) < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            value = None
+    if value is None:
+        raise LookupError(f"Invalid reference specified. No value for {path} found in {parts[0]}.")
+    return str(value)
+
+#Split a query result into pages, remembering the rest under a cursor served at nextRecordsUrl
+def paginate(result, page_size, cursors, cursor_ids):
+    records = result['records']
+    if not page_size or len(records) <= page_size:
+        return result
+    cursor = f"01g{next(cursor_ids):015d}-{page_size}"
+    cursors[cursor] = records[page_size:]
+    return {'totalSize': result['totalSize'], 'done': False, 'nextRecordsUrl': f"/services/data/v61.0/query/{cursor}", 'records': records[:page_size]}
+
+def make_handler(fixtures, latency_ms, stats, page_size=0):
+    cursors = {}
+    cursor_ids = itertools.count()
+
+    class FakeSalesforceHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def begin(self):
+            stats['requests'] += 1
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+
+        def authorized(self):
+            if self.headers.get('Authorization') != f"Bearer {stats['token']}":
+                self.send_json(401, [{'errorCode': 'INVALID_SESSION_ID', 'message': 'Session expired or invalid'}])
+                return False
+            return True
+
+        def do_GET(self):
+            self.begin()
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                return self.send_json(200, stats)
+            if not self.authorized():
+                return
+            cursor = url.path.rsplit('/', 1)[-1]
+            if cursor in cursors:
+                remaining = cursors.pop(cursor)
+                return self.send_json(200, paginate({'totalSize': len(remaining), 'done': True, 'records': remaining}, page_size, cursors, cursor_ids))
+            if '/query' in url.path:
+                soql = parse_qs(url.query)['q'][0]
+                return self.send_json(200, paginate(run_query(fixtures, soql), page_size, cursors, cursor_ids))
+            self.send_json(404, [{'errorCode': 'NOT_FOUND', 'message': url.path}])
+
+        def do_POST(self):
+            self.begin()
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            if url.path == '/services/oauth2/token':
+                stats['tokens_issued'] += 1
+                stats['token'] = f"fake-token-{stats['tokens_issued']}"
+                return self.send_json(200, {
+                    'access_token': stats['token'],
+                    'instance_url': f"http://{self.headers['Host']}",
+                    'token_type': 'Bearer'
+                })
+
+            if not self.authorized():
+                return
+
+            if url.path.endswith('/composite'):
+                results = {}
+                responses = []
+                for subrequest in json.loads(body)['compositeRequest']:
+                    try:
+                        sub_url = re.sub(r'@\{([^}]+)\}', lambda m: resolve_reference(results, m.group(1)), subrequest['url'])
+                    except LookupError as e:
+                        responses.append({
+                            'referenceId': subrequest['referenceId'],
+                            'httpStatusCode': 400,
+                            'httpHeaders': {},
+                            'body': [{'errorCode': 'PROCESSING_HALTED', 'message': str(e)}]
+                        })
+                        continue
+                    soql = unquote_plus(parse_qs(urlparse(sub_url).query, keep_blank_values=True)['q'][0])
+                    results[subrequest['referenceId']] = run_query(fixtures, soql)
+                    responses.append({
+                        'referenceId': subrequest['referenceId'],
+                        'httpStatusCode': 200,
+                        'httpHeaders': {},
+                        'body': results[subrequest['referenceId']]
+                    })
+                return self.send_json(200, {'compositeResponse': responses})
+
+            self.send_json(404, [{'errorCode': 'NOT_FOUND', 'message': url.path}])
+
+    return FakeSalesforceHandler
+
+#Start the fake server on a background thread, port 0 picks a free port
+def start_fake_salesforce(fixtures, port=0, latency_ms=0, page_size=0):
+    stats = {'requests': 0, 'tokens_issued': 0, 'token': None}
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fixtures, latency_ms, stats, page_size))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local fake Salesforce REST API')
+    parser.add_argument('fixtures')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=int, default=0)
+    parser.add_argument('--page-size', type=int, default=0, help='page top-level query results through nextRecordsUrl')
+    args = parser.parse_args()
+
+    with open(args.fixtures) as f:
+        fixtures = json.load(f)
+
+    server, stats = start_fake_salesforce(fixtures, args.port, args.latency_ms, args.page_size)
+    print(f"Fake Salesforce listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()